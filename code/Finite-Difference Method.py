@@ -3,6 +3,12 @@ import matplotlib.pyplot as plt
 from matplotlib.widgets import Button, Slider
 import matplotlib.gridspec as gridspec
 from matplotlib.backend_tools import Cursors
+from solver import State, FiniteDifferenceStepper, ADIStepper
+from geometry import MaskedStepper, load_mask
+from profiling import Profiler
+from convergence import SteadyState
+from render import FieldRenderer
+from preview import ProgressivePreview
 
 # Define the lake's size
 Lx, Ly = 200, 200                    # Length and width of the lake
@@ -12,9 +18,30 @@ nx, ny = int(Lx / dx), int(Ly / dy)  # Number of grid points
 # Define time step size and diffusion coefficient
 dt = 0.1  # Time step size
 D = 2.0   # Diffusion coefficient
-
-# Initialize the pollutant concentration matrix
-C = np.zeros((nx, ny))
+dtype = np.float64  # Precision (np.float32 halves memory and bandwidth)
+
+# Initialize the pollutant concentration matrix and the headless solver
+state = State(np.zeros((nx, ny), dtype), dx, dy, D, dt)
+use_implicit = False  # ADI stepper: unconditionally stable, allows a much larger dt
+stepper = ADIStepper(state) if use_implicit else FiniteDifferenceStepper(state)
+lake_mask = None  # Lake outline image (white = water), e.g. 'lake_mask.png', for a no-flux shoreline
+if lake_mask is not None:
+    water = load_mask(lake_mask, (nx, ny))
+    stepper = MaskedStepper(state, water, theta=0.5 if use_implicit else 0.0)
+steps_per_frame = 1  # Solver steps advanced between checks for a due frame
+max_fps = 30  # Frames rendered per second at most; the solver runs freely in between
+print(stepper.memory_report())
+# Per-phase timing with an on-canvas steps/s, FPS and ms overlay
+# (dump_path='profile.jsonl' also logs a summary every 10 s)
+profiler = Profiler(enabled=False)
+
+# Stop stepping once the lake no longer changes (e.g. after RESET), until a new source is added
+steady = SteadyState(stepper, tol=1e-4)
+
+# What-if mode for large grids: e.g. 50 makes a click show the lake 50 time units later,
+# first from 16x and 4x coarser grids, then exactly once the full-resolution run finishes
+preview_horizon = None
+preview = None
 
 # Create a figure window
 fig = plt.figure(figsize=(12, 8))
@@ -22,12 +49,17 @@ gs = gridspec.GridSpec(5, 2, width_ratios=[3, 1], height_ratios=[15, 1, 1, 1, 1]
 
 # Initial plot
 ax = fig.add_subplot(gs[:3, 0])
-im = ax.imshow(C, extent=[0, Lx, 0, Ly], origin='lower', cmap='viridis', vmin=0, vmax=10)
+im = ax.imshow(state.field, extent=[0, Lx, 0, Ly], origin='lower', cmap='viridis', vmin=0, vmax=10)
 plt.colorbar(im, ax=ax, label='Concentration')
+if lake_mask is not None:
+    ax.contour(water, levels=[0.5], colors='white', linewidths=1, extent=[0, Lx, 0, Ly], origin='lower')
 annotation = ax.annotate('', xy=(0.95, 0.05), xycoords='axes fraction', ha='right',
                          bbox=dict(boxstyle="round,pad=0.3", edgecolor="black", facecolor="yellow"),
                          arrowprops=dict(arrowstyle="->"))
 annotation.set_visible(False)
+ax.set_title('Pollutant Diffusion')
+# Redraws only the image and its overlays, downsampled for large grids
+renderer = FieldRenderer(im, fps=max_fps, artists=[annotation, profiler.attach_overlay(ax)])
 plt.draw()
 
 # Track current cursor type
@@ -39,21 +71,22 @@ concentration = initial_concentration  # Variable to store the pollution source
 
 # Mouse click event handler
 def onclick(event):
-    if event.button == 1 and current_cursor == Cursors.POINTER:  # Left click to add initial pollution source
-        iy, ix = int(event.xdata), int(event.ydata)
-        for i in range(max(0, ix - radius), min(nx, ix + radius)):
-            for j in range(max(0, iy - radius), min(ny, iy + radius)):
-                if (i - ix)**2 + (j - iy)**2 <= radius**2:
-                    C[i, j] = concentration
-        update_plot()
-    elif event.button == 3 and current_cursor == Cursors.POINTER:  # Right click to view pollutant concentration
-        iy, ix = int(event.xdata / dx), int(event.ydata / dy)
-        if 0 <= ix < nx and 0 <= iy < ny:
-            conc = C[ix, iy]
-            annotation.set_text(f'Pos: ({iy}, {ix})\nConc: {conc:.2f}')
-            annotation.xy = (0.95, 0.05)
-            annotation.set_visible(True)
-            plt.draw()
+    with profiler.phase('click'):
+        if event.button == 1 and current_cursor == Cursors.POINTER:  # Left click to add initial pollution source
+            iy, ix = int(event.xdata), int(event.ydata)
+            stepper.add_sources(ix, iy, radius, concentration)
+            steady.wake()
+            if preview_horizon is not None and stepper.name == 'fd':
+                start_preview()
+            update_plot()
+        elif event.button == 3 and current_cursor == Cursors.POINTER:  # Right click to view pollutant concentration
+            iy, ix = int(event.xdata / dx), int(event.ydata / dy)
+            if 0 <= ix < nx and 0 <= iy < ny:
+                conc = state.field[ix, iy]
+                annotation.set_text(f'Pos: ({iy}, {ix})\nConc: {conc:.2f}')
+                annotation.xy = (0.95, 0.05)
+                annotation.set_visible(True)
+                plt.draw()
 
 # Close window event handler
 def on_close(event):
@@ -62,14 +95,23 @@ def on_close(event):
 
 # Update plot function
 def update_plot():
-    im.set_data(C)
-    ax.set_title('Pollutant Diffusion')
-    plt.draw()
+    renderer.update(state.field)
+
+# Replace any running preview with one from the current state
+def start_preview():
+    global preview
+    if preview is not None:
+        preview.cancel()
+    preview = ProgressivePreview(stepper, state.t + preview_horizon)
 
 class Index:
     def rst(self, event):
-        global C
-        C.fill(0)  # Set all values in the concentration array to zero
+        global preview
+        if preview is not None:
+            preview.cancel()
+            preview = None
+        stepper.reset()  # Set all values in the concentration array to zero
+        steady.wake()
         update_plot()
 
 # Function to update the radius from the slider
@@ -123,18 +165,45 @@ fig.canvas.mpl_connect('motion_notify_event', change_cursor)
 
 
 # Simulation loop
+plt.show(block=False)
 running = True
 while running:  
-    # Vectorized calculation of the new concentration
-    C_new = C.copy()
-    C_new[1:nx-1, 1:ny-1] = C[1:nx-1, 1:ny-1] + D * dt * (
-        (C[2:nx, 1:ny-1] - 2 * C[1:nx-1, 1:ny-1] + C[0:nx-2, 1:ny-1]) / dx**2 +
-        (C[1:nx-1, 2:ny] - 2 * C[1:nx-1, 1:ny-1] + C[1:nx-1, 0:ny-2]) / dy**2
-    )
-    C = C_new
-    
-    # Real-time update of the image
-    update_plot()
-    plt.pause(0.001)  # Increase update frequency
+    # While previewing, show the coarse frames and then wait for the exact result
+    if preview is not None:
+        with profiler.phase('preview'):
+            field = preview.poll()
+        if preview.finished:
+            preview = None
+            steady.wake()
+        if field is not None:
+            renderer.update(field)
+            fig.canvas.flush_events()
+        else:
+            fig.canvas.start_event_loop(0.05)
+        continue
+
+    # Once the lake stops changing, only wait for clicks instead of stepping
+    if steady.converged:
+        fig.canvas.start_event_loop(0.1)
+        continue
+
+    # Advance the headless solver as fast as possible
+    with profiler.phase('step'):
+        stepper.advance(steps_per_frame)
+    profiler.count('steps', steps_per_frame)
+    if steady.converged:
+        update_plot()  # Show the final state before idling
+
+    # Real-time update of the image, at most max_fps times per second
+    if renderer.due():
+        with profiler.phase('render'):
+            update_plot()
+        with profiler.phase('events'):
+            fig.canvas.flush_events()  # Clicks, sliders and full redraws
+        profiler.count('frames')
+        profiler.tick()
 
 plt.close(fig)
+profiler.close()
+if profiler.enabled:
+    print(profiler.report())
@@ -3,6 +3,11 @@ import matplotlib.pyplot as plt
 from matplotlib.widgets import Button, Slider
 import matplotlib.gridspec as gridspec
 from matplotlib.backend_tools import Cursors
+from solver import State, ForwardEulerStepper, ADIStepper
+from sources import stamp
+from profiling import Profiler
+from convergence import SteadyState
+from render import FieldRenderer
 
 # Parameters
 Lx, Ly = 100, 100    # Length of the lake (square domain)
@@ -10,17 +15,27 @@ dx, dy = 0.5, 0.5    # Grid spacing
 nx, ny = int(Lx / dx), int(Ly / dy)
 D = 10.0             # Diffusion coefficient
 dt = 0.01            # Time step size
+dtype = np.float64   # Precision (np.float32 halves memory and bandwidth)
 
 # Initialize concentration array
-u = np.zeros((nx, ny))
+u = np.zeros((nx, ny), dtype)
 # Initial concentration spike in the middle in a circular shape
 cx, cy = nx // 2, ny // 2
 initial_radius = 5  # Initial radius of the pollution source
 initial_concentration = 10.0  # Initial concentration of the pollution source
-for i in range(nx):
-    for j in range(ny):
-        if (i - cx)**2 + (j - cy)**2 <= initial_radius**2:
-            u[i, j] = 1.0
+stamp(u, cx, cy, initial_radius, 1.0)
+state = State(u, dx, dy, D, dt)
+use_implicit = False  # ADI stepper: unconditionally stable, allows a much larger dt
+stepper = ADIStepper(state, boundary='no-flux') if use_implicit else ForwardEulerStepper(state)
+steps_per_frame = 1  # Solver steps advanced between checks for a due frame
+max_fps = 30  # Frames rendered per second at most; the solver runs freely in between
+print(stepper.memory_report())
+# Per-phase timing with an on-canvas steps/s, FPS and ms overlay
+# (dump_path='profile.jsonl' also logs a summary every 10 s)
+profiler = Profiler(enabled=False)
+
+# Stop stepping once the lake no longer changes (e.g. after RESET), until a new source is added
+steady = SteadyState(stepper, tol=1e-4)
 
 # Track current cursor type
 current_cursor = None
@@ -30,22 +45,22 @@ concentration = initial_concentration  # Variable to store the pollution source
 # Function to add pollution source
 def add_pollution(event):
     if event.button == 1 and current_cursor == Cursors.POINTER:  # Left click and cursor is POINTER
-        iy, ix = int(event.xdata / dx), int(event.ydata / dy)
-        for i in range(max(0, ix - radius), min(nx, ix + radius)):
-            for j in range(max(0, iy - radius), min(ny, iy + radius)):
-                if (i - ix)**2 + (j - iy)**2 <= radius**2:
-                    u[i, j] = concentration
-        update_plot()
+        with profiler.phase('click'):
+            iy, ix = int(event.xdata / dx), int(event.ydata / dy)
+            stepper.add_sources(ix, iy, radius, concentration)
+            steady.wake()
+            update_plot()
 
 def show_concentration(event):
     if event.button == 3 and current_cursor == Cursors.POINTER:  # Right click
-        iy, ix = int(event.xdata / dx), int(event.ydata / dy)
-        if 0 <= iy < nx and 0 <= ix < ny:
-            concentration = u[ix, iy]
-            annotation.set_text(f'Pos: ({iy}, {ix})\nConc: {concentration:.2f}')
-            annotation.xy = (0.95, 0.05)
-            annotation.set_visible(True)
-            plt.draw()
+        with profiler.phase('click'):
+            iy, ix = int(event.xdata / dx), int(event.ydata / dy)
+            if 0 <= iy < nx and 0 <= ix < ny:
+                concentration = state.field[ix, iy]
+                annotation.set_text(f'Pos: ({iy}, {ix})\nConc: {concentration:.2f}')
+                annotation.xy = (0.95, 0.05)
+                annotation.set_visible(True)
+                plt.draw()
 
 def on_close(event):
     global running
@@ -53,16 +68,14 @@ def on_close(event):
 
 # Update plot function
 def update_plot():
-    im.set_data(u)
-    ax.set_title('Pollutant Diffusion')
-    plt.draw()
+    renderer.update(state.field)
 
 class Index:
     ind = 0
 
     def rst(self, event):
-        global u
-        u.fill(0)  # Set all values in the concentration array to zero
+        stepper.reset()  # Set all values in the concentration array to zero
+        steady.wake()
         update_plot()
 
 # Function to update the radius from the slider
@@ -81,12 +94,15 @@ gs = gridspec.GridSpec(4, 2, width_ratios=[3, 1], height_ratios=[15, 1, 1, 1])
 
 # Plot in the left column, spanning all rows
 ax = fig.add_subplot(gs[:, 0])
-im = ax.imshow(u, extent=[0, Lx, 0, Ly], origin='lower', cmap='viridis', vmin=0, vmax=10)
+im = ax.imshow(state.field, extent=[0, Lx, 0, Ly], origin='lower', cmap='viridis', vmin=0, vmax=10)
 plt.colorbar(im, ax=ax, label='Concentration')
 annotation = ax.annotate('', xy=(0.95, 0.05), xycoords='axes fraction', ha='right',
                          bbox=dict(boxstyle="round,pad=0.3", edgecolor="black", facecolor="yellow"),
                          arrowprops=dict(arrowstyle="->"))
 annotation.set_visible(False)
+ax.set_title('Pollutant Diffusion')
+# Redraws only the image and its overlays, downsampled for large grids
+renderer = FieldRenderer(im, fps=max_fps, artists=[annotation, profiler.attach_overlay(ax)])
 plt.draw()
 
 # Buttons in the right bottom corner
@@ -130,23 +146,31 @@ fig.canvas.mpl_connect('close_event', on_close)
 fig.canvas.mpl_connect('motion_notify_event', change_cursor)
 
 # Simulation loop
+plt.show(block=False)
 running = True
 while running:  # Infinite loop until window is closed
-    # Compute fluxes (diffusion)
-    flux_x = D * (np.roll(u, -1, axis=0) - np.roll(u, 1, axis=0)) / (2 * dx)
-    flux_y = D * (np.roll(u, -1, axis=1) - np.roll(u, 1, axis=1)) / (2 * dy)
-
-    # Update concentration using Forward Euler method
-    u += dt * (flux_x - np.roll(flux_x, 1, axis=0) + flux_y - np.roll(flux_y, 1, axis=1))
-
-    # Boundary conditions (no-flux)
-    u[0, :] = u[1, :]
-    u[-1, :] = u[-2, :]
-    u[:, 0] = u[:, 1]
-    u[:, -1] = u[:, -2]
-
-    # Update plot
-    update_plot()
-    plt.pause(0.01)  # Adjust the pause time as needed
+    # Once the lake stops changing, only wait for clicks instead of stepping
+    if steady.converged:
+        fig.canvas.start_event_loop(0.1)
+        continue
+
+    # Advance the headless solver (Forward Euler, no-flux boundaries)
+    with profiler.phase('step'):
+        stepper.advance(steps_per_frame)
+    profiler.count('steps', steps_per_frame)
+    if steady.converged:
+        update_plot()  # Show the final state before idling
+
+    # Update plot, at most max_fps times per second
+    if renderer.due():
+        with profiler.phase('render'):
+            update_plot()
+        with profiler.phase('events'):
+            fig.canvas.flush_events()  # Clicks, sliders and full redraws
+        profiler.count('frames')
+        profiler.tick()
 
 plt.close(fig)
+profiler.close()
+if profiler.enabled:
+    print(profiler.report())
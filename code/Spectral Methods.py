@@ -4,7 +4,11 @@ from matplotlib.animation import FuncAnimation
 from matplotlib.widgets import Button, Slider
 import matplotlib.gridspec as gridspec
 from matplotlib.backend_tools import Cursors
-from scipy.fft import fft2, ifft2
+from solver import State, SpectralStepper
+from profiling import Profiler
+from convergence import SteadyState
+from render import display_factor, downsample
+from preview import ProgressivePreview
 
 # Define parameters
 L = 100.0  # Region length
@@ -12,23 +16,32 @@ N = 100  # Number of grid points
 D = 10  # Diffusion coefficient
 T = 10.0  # Simulation time
 dt = 0.01  # Time step
+dtype = np.float64  # Precision (np.float32 halves memory and bandwidth)
 timesteps = int(T / dt)
 
 # Define space and initial conditions
 x = np.linspace(0, L, N, endpoint=False)
 y = np.linspace(0, L, N, endpoint=False)
-X, Y = np.meshgrid(x, y)
-u0 = np.exp(-((X - L/2)**2 + (Y - L/2)**2))  # Gaussian initial distribution
-
-# Fourier modes
-kx = np.fft.fftfreq(N, L/N) * 2 * np.pi
-ky = np.fft.fftfreq(N, L/N) * 2 * np.pi
-KX, KY = np.meshgrid(kx, ky)
-K2 = KX**2 + KY**2
-
-# Initialize solution
-u = u0.copy()
-u_hat = fft2(u)
+# Gaussian initial distribution, broadcast from the 1-D coordinates
+u0 = np.exp(-((x[None, :] - L/2)**2 + (y[:, None] - L/2)**2)).astype(dtype)
+
+# Initialize solution; the stepper holds the Fourier modes and u_hat
+state = State(u0.copy(), L/N, L/N, D, dt)
+stepper = SpectralStepper(state)
+steps_per_frame = 1  # Solver steps advanced per animation frame
+max_fps = 30  # Animation frames per second at most
+print(stepper.memory_report())
+# Per-phase timing with an on-canvas steps/s, FPS and ms overlay
+# (dump_path='profile.jsonl' also logs a summary every 10 s)
+profiler = Profiler(enabled=False)
+
+# Pause the animation once the lake no longer changes, until a new source is added
+steady = SteadyState(stepper, tol=1e-4)
+
+# What-if mode for large grids: e.g. 5 makes a click show the lake 5 time units later,
+# first from 16x and 4x fewer modes, then exactly once the full-resolution result is ready
+preview_horizon = None
+preview = None
 
 # Create a figure window
 fig = plt.figure(figsize=(12, 8))
@@ -48,7 +61,7 @@ vmin = 0
 vmax = 10
 
 # Use imshow to plot the initial image
-im = ax.imshow(u, extent=[0, L, 0, L], origin='lower', cmap='viridis', vmin=vmin, vmax=vmax, aspect='auto')
+im = ax.imshow(state.field, extent=[0, L, 0, L], origin='lower', cmap='viridis', vmin=vmin, vmax=vmax, aspect='auto')
 cbar = fig.colorbar(im, ax=ax, label='Pollutant Concentration')
 
 # Set the title and axis labels
@@ -58,37 +71,60 @@ ax.set_ylabel('y')
 
 # Initialize right-click annotation
 annotation = ax.annotate('', xy=(0, 0), xycoords='data', bbox=dict(boxstyle='round,pad=0.5', fc='yellow', alpha=0.5))
+overlay = profiler.attach_overlay(ax)
 
 # Update function for animation
 def update(frame):
-    global u_hat, u, last_click_right
-    u_hat = u_hat * np.exp(-D * K2 * dt)  # Time evolution
-    u = np.real(ifft2(u_hat))  # Inverse transform to get real space solution
-    im.set_data(u)
-    if not last_click_right:
-        annotation.set_visible(False)  # Hide annotation if the last click was not right-click
-    return im,
+    global preview
+    if preview is not None:
+        # Coarse frames first, then the exact result; the lake waits meanwhile
+        with profiler.phase('preview'):
+            field = preview.poll()
+        if field is not None:
+            im.set_data(downsample(field, display_factor(ax, field.shape)))
+        if preview.finished:
+            preview = None
+            steady.wake()
+        return [artist for artist in (im, annotation, overlay) if artist is not None]
+    with profiler.phase('step'):
+        stepper.advance(steps_per_frame)  # Time evolution in Fourier space
+    profiler.count('steps', steps_per_frame)
+    with profiler.phase('plot'):
+        # Inverse FFT, downsampled to about one cell per pixel for large grids
+        field = state.field
+        im.set_data(downsample(field, display_factor(ax, field.shape)))
+        if not last_click_right:
+            annotation.set_visible(False)  # Hide annotation if the last click was not right-click
+    profiler.count('frames')
+    profiler.tick()
+    if steady.converged:
+        ani.pause()
+    # Only these artists are redrawn (blitted) each frame
+    return [artist for artist in (im, annotation, overlay) if artist is not None]
 
 # Mouse click event handler
 def onclick(event):
-    global last_click_right
-    if event.xdata is not None and event.ydata is not None:
-        ix, iy = int(event.xdata * N / L), int(event.ydata * N / L)
-        if event.button == 1 and current_cursor == Cursors.POINTER:  # Left-click to add initial pollutant source
-            last_click_right = False
-            for i in range(max(0, ix - radius), min(N, ix + radius)):
-                for j in range(max(0, iy - radius), min(N, iy + radius)):
-                    if (i - ix)**2 + (j - iy)**2 <= radius**2:
-                        u[j, i] += concentration  # Add pollutant source
-            global u_hat
-            u_hat = fft2(u)  # Update Fourier transform
-        elif event.button == 3 and current_cursor == Cursors.POINTER:  # Right-click to view concentration
-            last_click_right = True
-            conc = u[iy, ix]
-            annotation.xy = (event.xdata, event.ydata)
-            annotation.set_text(f'({event.xdata:.1f}, {event.ydata:.1f})\nConcentration: {conc:.2f}')
-            annotation.set_visible(True)
-            plt.draw()
+    global last_click_right, preview
+    with profiler.phase('click'):
+        if event.xdata is not None and event.ydata is not None:
+            ix, iy = int(event.xdata * N / L), int(event.ydata * N / L)
+            if event.button == 1 and current_cursor == Cursors.POINTER:  # Left-click to add initial pollutant source
+                last_click_right = False
+                # Add pollutant source; the Fourier transform is updated incrementally
+                stepper.add_sources(iy, ix, radius, concentration, mode='add')
+                steady.wake()
+                if preview_horizon is not None:
+                    if preview is not None:
+                        preview.cancel()
+                    preview = ProgressivePreview(stepper, state.t + preview_horizon)
+                ani.resume()
+            elif event.button == 3 and current_cursor == Cursors.POINTER:  # Right-click to view concentration
+                last_click_right = True
+                conc = state.field[iy, ix]
+                annotation.xy = (event.xdata, event.ydata)
+                annotation.set_text(f'({event.xdata:.1f}, {event.ydata:.1f})\nConcentration: {conc:.2f}')
+                annotation.set_visible(True)
+                plt.draw()
 
 # Close window event handler
 def on_close(event):
@@ -97,15 +133,19 @@ def on_close(event):
 
 # Update plot function
 def update_plot():
-    im.set_data(u)
-    ax.set_title('Pollutant Diffusion')
+    field = state.field
+    im.set_data(downsample(field, display_factor(ax, field.shape)))
     plt.draw()
 
 class Index:
     def rst(self, event):
-        global u, u_hat
-        u.fill(0)  # Set all values in the concentration array to zero
-        u_hat = fft2(u)  # Update Fourier transform
+        global preview
+        if preview is not None:
+            preview.cancel()
+            preview = None
+        stepper.reset()  # Zero the concentration array and its Fourier transform
+        steady.wake()
+        ani.resume()
         update_plot()
 
 # Function to update the radius from the slider
@@ -158,7 +198,10 @@ fig.canvas.mpl_connect('close_event', on_close)
 fig.canvas.mpl_connect('motion_notify_event', change_cursor)
 
 # Create animation
-ani = FuncAnimation(fig, update, frames=timesteps, blit=False, repeat=False)
+ani = FuncAnimation(fig, update, frames=timesteps, interval=1000 / max_fps, blit=True, repeat=False)
 
 # Show plot
 plt.show()
+profiler.close()
+if profiler.enabled:
+    print(profiler.report())
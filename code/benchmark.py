@@ -0,0 +1,285 @@
+import argparse
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+
+from solver import STEPPERS, State, FiniteDifferenceStepper, ForwardEulerStepper
+from ensemble import random_ensemble
+
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+
+# Explicit kernels and a stable (D, dt) for each on a unit-spaced grid
+KERNELS = {
+    'fd': (FiniteDifferenceStepper, 2.0, 0.1),
+    'euler': (ForwardEulerStepper, 2.0, 0.01),
+}
+
+
+# Peak resident set size of this process in MB (None where unsupported)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+# Initial field: a square pollution source in the middle of the lake
+def initial_field(size):
+    field = np.zeros((size, size))
+    c = size // 2
+    field[c - size // 10:c + size // 10, c - size // 10:c + size // 10] = 10.0
+    return field
+
+
+# Time one kernel configuration; meant to run in a fresh process so that
+# the peak RSS belongs to this configuration alone
+def run_kernel_case(method, size, steps, buffered):
+    cls, D, dt = KERNELS[method]
+    stepper = cls(State(initial_field(size), 1.0, 1.0, D, dt), buffered=buffered)
+    stepper.advance(2)  # Warm up (allocates the buffers of the buffered path)
+    start = time.perf_counter()
+    stepper.advance(steps)
+    elapsed = time.perf_counter() - start
+    return {
+        'method': method,
+        'size': size,
+        'buffered': buffered,
+        'steps': steps,
+        'steps_per_sec': steps / elapsed,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+# Run a case in a child interpreter and return its result dict
+def run_isolated(case, **kwargs):
+    cmd = [sys.executable, __file__, '_case', case, json.dumps(kwargs)]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def print_table(rows, columns):
+    print('  '.join(f'{name:>{width}}' for name, width, _ in columns))
+    for row in rows:
+        cells = []
+        for name, width, fmt in columns:
+            value = row[name]
+            cells.append(f'{"-" if value is None else format(value, fmt):>{width}}')
+        print('  '.join(cells))
+
+
+# Compare the buffered (allocation-free) kernels against the reference path
+def bench_kernels(args):
+    rows = []
+    for method in args.methods:
+        for size in args.sizes:
+            for buffered in (False, True):
+                rows.append(run_isolated('kernel', method=method, size=size,
+                                         steps=args.steps, buffered=buffered))
+    print_table(rows, [('method', 6, 's'), ('size', 6, 'd'), ('buffered', 8, ''),
+                       ('steps_per_sec', 13, '.1f'), ('peak_rss_mb', 11, '.1f')])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+# Compare one batched ensemble stepper with advancing its members one by one
+def bench_ensemble(args):
+    rows = []
+    for method in args.methods:
+        batched = random_ensemble(method, args.members, seed=0)
+        s = batched.state
+        singles = [STEPPERS[method](State(field.copy(), s.dx, s.dy, D, s.dt))
+                   for field, D in zip(s.field, s.D)]
+
+        start = time.perf_counter()
+        for stepper in singles:
+            stepper.advance(args.steps)
+            stepper.state.field  # Include the inverse transform of the spectral method
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batched.advance(args.steps)
+        batched.state.field
+        together = time.perf_counter() - start
+
+        rows.append({'method': method, 'members': args.members,
+                     'sequential_s': sequential, 'batched_s': together,
+                     'speedup': sequential / together})
+    print_table(rows, [('method', 8, 's'), ('members', 7, 'd'), ('sequential_s', 12, '.3f'),
+                       ('batched_s', 9, '.3f'), ('speedup', 7, '.1f')])
+
+
+# Speedup of the multi-threaded strip kernels over one worker
+def bench_scaling(args):
+    rows = []
+    for method in args.methods:
+        cls, D, dt = KERNELS[method]
+        reference, base_rate = None, None
+        for workers in args.workers:
+            stepper = cls(State(initial_field(args.size), 1.0, 1.0, D, dt), workers=workers)
+            stepper.advance(1)
+            start = time.perf_counter()
+            stepper.advance(args.steps)
+            rate = args.steps / (time.perf_counter() - start)
+            stepper.close()
+            if reference is None:
+                reference, base_rate = stepper.state.field, rate
+            rows.append({'method': method, 'size': args.size, 'workers': workers,
+                         'steps_per_sec': rate, 'speedup': rate / base_rate,
+                         'identical': bool(np.array_equal(stepper.state.field, reference))})
+    print_table(rows, [('method', 6, 's'), ('size', 6, 'd'), ('workers', 7, 'd'),
+                       ('steps_per_sec', 13, '.2f'), ('speedup', 7, '.2f'), ('identical', 9, '')])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+# Free-space solution of the heat equation for the Gaussian initial field of
+# the spectral script, exp(-r**2) centred in an L x L lake of N x N cells
+def gaussian(N, L, D, t):
+    x = np.arange(N) * (L / N) - L / 2
+    spread = 1 + 4 * D * t
+    return np.exp(-(x[:, None]**2 + x[None, :]**2) / spread) / spread
+
+
+# NaN/inf (e.g. from an unstable run) as None, so the results stay valid JSON
+def _finite(value):
+    return value if math.isfinite(value) else None
+
+
+# Run one method from the Gaussian initial field to t_end and compare it with
+# the analytic solution. Errors are relative (L2 and max norm).
+def run_accuracy_case(method, N, L, D, dt, t_end):
+    def make():
+        return STEPPERS[method](State(gaussian(N, L, D, 0), L / N, L / N, D, dt))
+
+    n_steps = max(round(t_end / dt), 1)
+    stepper = make()
+    with np.errstate(all='ignore'):
+        start = time.perf_counter()
+        stepper.advance(n_steps)
+        field = stepper.state.field
+        elapsed = time.perf_counter() - start
+        exact = gaussian(N, L, D, n_steps * dt)
+        err = field - exact
+        l2 = float(np.sqrt(np.sum(err**2) / np.sum(exact**2)))
+        linf = float(np.max(np.abs(err)) / np.max(exact))
+
+    # Peak traced memory of a fresh stepper over a few steps (steady state)
+    tracemalloc.start()
+    make().advance(min(n_steps, 3))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'method': method, 'N': N, 'L': L, 'D': D, 'dt': dt, 't_end': n_steps * dt,
+        'steps': n_steps, 'wall_s': elapsed, 'steps_per_sec': n_steps / elapsed,
+        'peak_mb': peak / 1024**2, 'l2_error': _finite(l2), 'linf_error': _finite(linf),
+    }
+
+
+# Cheapest (shortest wall time) result whose L2 error meets the budget,
+# optionally for one method only; None if no run is accurate enough
+def recommend(rows, max_error, method=None):
+    ok = [row for row in rows if row['l2_error'] is not None and row['l2_error'] <= max_error
+          and (method is None or row['method'] == method)]
+    return min(ok, key=lambda row: row['wall_s'], default=None)
+
+
+# Accuracy/cost matrix of all methods against the analytic Gaussian
+def bench_accuracy(args):
+    rows = []
+    for method in args.methods:
+        for N in args.sizes:
+            for D in args.D:
+                for dt in args.dt:
+                    rows.append(run_accuracy_case(method, N, args.L, D, dt, args.t_end))
+    print_table(rows, [('method', 8, 's'), ('N', 5, 'd'), ('D', 5, 'g'), ('dt', 7, 'g'),
+                       ('steps_per_sec', 13, '.1f'), ('wall_s', 8, '.4f'), ('peak_mb', 7, '.2f'),
+                       ('l2_error', 9, '.2e'), ('linf_error', 10, '.2e')])
+
+    print(f'\ntime to solution at L2 error <= {args.target:g}:')
+    for method in args.methods:
+        best = recommend(rows, args.target, method)
+        if best is None:
+            print(f'  {method:>8}: no run met the target')
+        else:
+            print(f'  {method:>8}: {best["wall_s"]:.4f} s (N={best["N"]}, D={best["D"]:g}, dt={best["dt"]:g})')
+    best = recommend(rows, args.target)
+    if best is not None:
+        print(f'cheapest method meeting the budget: {best["method"]}')
+
+    if args.json:
+        result = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'platform': platform.platform(),
+            'target_error': args.target, 'results': rows,
+        }
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+CASES = {
+    'kernel': run_kernel_case,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == '_case':
+        # Child process entry point used by run_isolated()
+        print(json.dumps(CASES[argv[1]](**json.loads(argv[2]))))
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmarks for the headless solvers.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('kernels', help='buffered vs reference FD/Euler kernels')
+    p.add_argument('--methods', nargs='+', choices=sorted(KERNELS), default=sorted(KERNELS))
+    p.add_argument('--sizes', nargs='+', type=int, default=[500, 2000])
+    p.add_argument('--steps', type=int, default=50)
+    p.add_argument('--json', help='also write the results to this JSON file')
+    p.set_defaults(func=bench_kernels)
+
+    p = sub.add_parser('scaling', help='multi-threaded FD/Euler speedup vs workers')
+    p.add_argument('--methods', nargs='+', choices=sorted(KERNELS), default=sorted(KERNELS))
+    p.add_argument('--size', type=int, default=4000)
+    p.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8])
+    p.add_argument('--steps', type=int, default=10)
+    p.add_argument('--json', help='also write the results to this JSON file')
+    p.set_defaults(func=bench_scaling)
+
+    p = sub.add_parser('accuracy', help='cost and error of every method vs the analytic Gaussian')
+    p.add_argument('--methods', nargs='+', choices=sorted(STEPPERS), default=sorted(STEPPERS))
+    p.add_argument('--sizes', nargs='+', type=int, default=[100, 200])
+    p.add_argument('--D', nargs='+', type=float, default=[2.0, 10.0])
+    p.add_argument('--dt', nargs='+', type=float, default=[0.1, 0.02, 0.005])
+    p.add_argument('--L', type=float, default=100.0, help='lake size')
+    p.add_argument('--t-end', type=float, default=1.0)
+    p.add_argument('--target', type=float, default=1e-3, help='L2 error budget')
+    p.add_argument('--json', help='write the results (with versions) to this JSON file')
+    p.set_defaults(func=bench_accuracy)
+
+    p = sub.add_parser('ensemble', help='batched ensemble vs one stepper per member')
+    p.add_argument('--methods', nargs='+', choices=sorted(STEPPERS), default=['fd', 'euler', 'spectral'])
+    p.add_argument('--members', type=int, default=100)
+    p.add_argument('--steps', type=int, default=20)
+    p.set_defaults(func=bench_ensemble)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
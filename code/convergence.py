@@ -0,0 +1,78 @@
+import numpy as np
+
+
+# Detects when a run has reached a steady state (or has been reset to an
+# empty lake): every `every_steps` steps the largest change of the field
+# since the previous check, per unit of simulated time, is compared with tol.
+# Checking every few steps keeps the cost to a fraction of a step; the field
+# is compared with a preallocated copy, or for a spectral stepper the change
+# is bounded from the Fourier coefficients without an inverse transform.
+# After sources are added call wake() so that a paused interactive loop
+# resumes stepping.
+#   steady = SteadyState(stepper, tol=1e-4)
+#   run_until_steady(stepper, 100000, steady)
+class SteadyState:
+    def __init__(self, stepper, tol=1e-4, every_steps=10):
+        s = stepper.state
+        self.stepper = stepper
+        self.tol = tol
+        self.every_steps = every_steps
+        self.ny = s.field.shape[-1]
+        self.rate = np.inf        # Largest change per unit time at the last check
+        self.converged = False
+        self.t_converged = None   # Time at which the run was first seen converged
+        self._prev = self._buf = self._prev_hat = None
+        self._prev_t = None
+        self.observer = stepper.attach(self, every_steps=every_steps)
+        self._remember(s)
+
+    def _remember(self, state):
+        if state.u_hat is not None:
+            self._prev_hat = state.u_hat.copy()
+        else:
+            if self._prev is None or self._prev.shape != state.field.shape:
+                self._prev = np.empty_like(state.field)
+                self._buf = np.empty_like(state.field)
+            np.copyto(self._prev, state.field)
+        self._prev_t = state.t
+
+    # Observer callback
+    def __call__(self, state):
+        if state.t <= self._prev_t:
+            return
+        if state.u_hat is not None:
+            # max |u - prev| <= sum over the full spectrum of |u_hat - prev_hat| / (nx ny)
+            diff = np.abs(state.u_hat - self._prev_hat)
+            diff[..., 1:(self.ny + 1) // 2] *= 2
+            change = diff.sum(axis=(-2, -1)).max() / (diff.shape[-2] * self.ny)
+        else:
+            np.subtract(state.field, self._prev, out=self._buf)
+            np.abs(self._buf, out=self._buf)
+            change = self._buf.max()
+        self.rate = change / (state.t - self._prev_t)
+        converged = self.rate < self.tol
+        if converged and not self.converged:
+            self.t_converged = state.t
+        self.converged = converged
+        self._remember(state)
+
+    # Call after the field was modified from outside (new sources, reset)
+    def wake(self):
+        self.converged = False
+        self.t_converged = None
+        self.rate = np.inf
+        self._remember(self.stepper.state)
+
+    def detach(self):
+        self.stepper.detach(self.observer)
+
+
+# Advance up to max_steps, stopping early once steady reports convergence
+# and no scheduled sources are pending; returns whether it converged
+def run_until_steady(stepper, max_steps, steady):
+    end = stepper.state.step + max_steps
+    while stepper.state.step < end:
+        stepper.advance(min(steady.every_steps, end - stepper.state.step))
+        if steady.converged and not len(stepper.pending):
+            return True
+    return steady.converged
@@ -0,0 +1,114 @@
+import argparse
+import time
+
+import numpy as np
+
+import sources
+from solver import STEPPERS, State, default_stepper
+
+
+# Build one stepper that advances a whole ensemble of lake scenarios as a
+# single (batch, nx, ny) array. Every member starts from the default scenario
+# of the method (same grid, dt and initial field as the script), with its own
+# diffusion coefficient D[k] and its own source events events[k] (EVENT_DTYPE
+# arrays in physical units, or None).
+def ensemble_stepper(method, D, events=None):
+    base = default_stepper(method).state
+    D = np.asarray(D, float).ravel()
+    field = np.repeat(base.field[None], len(D), axis=0)
+    if events is not None:
+        if len(events) != len(D):
+            raise ValueError(f'got {len(events)} event lists for {len(D)} members')
+        for member, member_events in zip(field, events):
+            if member_events is not None and len(member_events):
+                i, j = sources.to_grid(member_events, base.dx, base.dy)
+                sources.stamp(member, i, j, member_events['radius'],
+                              member_events['concentration'], member_events['mode'],
+                              base.dx, base.dy)
+    return STEPPERS[method](State(field, base.dx, base.dy, D, base.dt))
+
+
+# Advance an ensemble to t_end and summarize it. Every sample_every steps the
+# per-member peak concentration and the probe values (x, y in physical units)
+# are checked; time_to_threshold[k, p] is the first sampled time at which
+# member k reached threshold at probe p (NaN if it never did). The final
+# fields are reduced to their mean and the requested percentiles.
+def run_ensemble(stepper, t_end, probes=(), threshold=None, sample_every=10,
+                 percentiles=(5, 50, 95)):
+    s = stepper.state
+    n = s.field.shape[0]
+    probes = np.asarray(probes, float).reshape(-1, 2)
+    pi = (probes[:, 1] / s.dx).astype(int)
+    pj = (probes[:, 0] / s.dy).astype(int)
+
+    peak = s.field.max(axis=(-2, -1))
+    reached = np.full((n, len(probes)), np.nan)
+    while s.t < t_end - 1e-9 * s.dt:
+        n_steps = min(sample_every, int(np.ceil((t_end - s.t) / s.dt - 1e-9)))
+        stepper.advance(n_steps)
+        field = s.field
+        np.maximum(peak, field.max(axis=(-2, -1)), out=peak)
+        if threshold is not None and len(probes):
+            hit = np.isnan(reached) & (field[:, pi, pj] >= threshold)
+            reached[hit] = s.t
+
+    field = s.field
+    return {
+        't': s.t,
+        'D': np.broadcast_to(s.D, (n,)).copy(),
+        'max_concentration': peak,
+        'time_to_threshold': reached,
+        'mean': field.mean(axis=0),
+        'percentiles': {q: np.percentile(field, q, axis=0) for q in percentiles},
+    }
+
+
+# Random ensemble for quick risk studies: one source per member with location,
+# radius and concentration drawn over the slider ranges of the scripts, and D
+# drawn between half and all of the script's value (which keeps the explicit
+# methods within their stability limit)
+def random_ensemble(method, n_members, seed=None):
+    rng = np.random.default_rng(seed)
+    base = default_stepper(method).state
+    Lx, Ly = base.field.shape[0] * base.dx, base.field.shape[1] * base.dy
+    events = np.zeros((n_members, 1), sources.EVENT_DTYPE)
+    events['x'] = rng.uniform(0, Ly, (n_members, 1))
+    events['y'] = rng.uniform(0, Lx, (n_members, 1))
+    events['radius'] = rng.uniform(1, 10, (n_members, 1)) * base.dx
+    events['concentration'] = rng.uniform(1, 10, (n_members, 1))
+    events['mode'] = 'set'
+    return ensemble_stepper(method, base.D * rng.uniform(0.5, 1, n_members), list(events))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a random ensemble of lake scenarios.')
+    parser.add_argument('method', choices=sorted(STEPPERS))
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--t-end', type=float, default=1.0)
+    parser.add_argument('--threshold', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='save the summary to this .npz file')
+    args = parser.parse_args(argv)
+
+    stepper = random_ensemble(args.method, args.members, args.seed)
+    s = stepper.state
+    centre = (s.field.shape[-1] * s.dy / 2, s.field.shape[-2] * s.dx / 2)
+    start = time.perf_counter()
+    summary = run_ensemble(stepper, args.t_end, probes=[centre], threshold=args.threshold)
+    elapsed = time.perf_counter() - start
+
+    reached = ~np.isnan(summary['time_to_threshold'][:, 0])
+    print(f'{args.method}: {args.members} members to t={summary["t"]:.4g} in {elapsed:.3f} s '
+          f'({args.members * s.step / elapsed:.1f} member-steps/s)')
+    print(f'peak concentration: median {np.median(summary["max_concentration"]):.3g}, '
+          f'max {summary["max_concentration"].max():.3g}; '
+          f'{reached.sum()} members reached {args.threshold} at the centre')
+    if args.output:
+        np.savez(args.output, t=summary['t'], D=summary['D'],
+                 max_concentration=summary['max_concentration'],
+                 time_to_threshold=summary['time_to_threshold'], mean=summary['mean'],
+                 **{f'p{q:g}': field for q, field in summary['percentiles'].items()})
+
+
+if __name__ == '__main__':
+    main()
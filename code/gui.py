@@ -1,57 +1,13 @@
 import flet as ft
-import matplotlib.pyplot as plt
-import numpy as np
-import io
-from PIL import Image
-import subprocess
 import sys
+from runner import SimulationRunner
 
-# Function to run the selected mode script and generate the plot
-def run_mode_script(mode):
-    if mode == "Finite-Difference Method":
-        script_path = "code/Finite-Difference Method.py"
-    elif mode == "Forword Euler Method":
-        script_path = "code/Forword Euler Method.py"
-    elif mode == "Spectral Methods":
-        script_path = "code/Spectral Methods.py"
-
-    else:
-        plt.figure()
-        x = np.linspace(0, 10, 100)
-        y = np.sin(x)
-        plt.plot(x, y)
-        plt.title("Default Mode")
-        plt.savefig("default_mode_plot.png")
-        return "default_mode_plot.png"
-
-    # Run the script using subprocess
-    result = subprocess.run([sys.executable, script_path], capture_output=True, text=True)
-    print(result.stdout)
-    print(result.stderr)
-    # Assuming the scripts save the plots with a specific name
-    plot_path = f"{mode.lower().replace(' ', '_')}_plot.png"
-    return plot_path
-
-# Function to display the plot in the Flet application
-def display_plot(page, plot_path):
-    # Read the plot image
-    img = Image.open(plot_path)
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    img_data = buffer.getvalue()
-
-    # Create an Flet Image control with the plot
-    plot_image = ft.Image(
-        src_base64=img_data,
-        width=600,
-        height=400,
-        fit=ft.ImageFit.CONTAIN,
-    )
-
-    # Add the image to the page
-    page.controls.clear()
-    page.add(plot_image)
-    page.update()
+# Solver behind each mode of the dropdown
+MODES = {
+    "Finite-Difference Method": "fd",
+    "Forword Euler Method": "euler",
+    "Spectral Methods": "spectral",
+}
 
 def main(page: ft.Page):
     page.title = "Pollution Simulation"
@@ -85,23 +41,87 @@ def main(page: ft.Page):
         ]
     )
 
+    # Live simulation frames; tap to add a pollution source
+    frame_image = ft.Image(
+        width=400,
+        height=400,
+        fit=ft.ImageFit.CONTAIN,
+        gapless_playback=True,
+    )
+
+    def add_source(e):
+        runner.add_source(e.local_x / frame_image.width, e.local_y / frame_image.height)
+
+    viewer = ft.GestureDetector(content=frame_image, on_tap_down=add_source)
+    status = ft.Text("")
+
+    # Called from the solver thread at most runner.fps times per second
+    def show_frame(image, stepper):
+        frame_image.src_base64 = image
+        status.value = f"t = {stepper.state.t:.2f}  (step {stepper.state.step})"
+        if left_column.controls[1] is not viewer:
+            left_column.controls[1] = viewer
+        page.update()
+
+    # The solver runs in a background thread of this process
+    runner = SimulationRunner(show_frame)
+
     # Start button click event handler
     def start_button_click(e):
-        selected_mode = mode_dropdown.value
-        plot_path = run_mode_script(selected_mode)
-        display_plot(page, plot_path)
-
-    # Start button
+        if mode_dropdown.value in MODES:
+            runner.start(MODES[mode_dropdown.value])
+            pause_button.text = "Pause"
+            page.update()
+
+    # Switch a running simulation to the newly selected mode
+    def mode_changed(e):
+        if runner.stepper is not None and mode_dropdown.value in MODES:
+            runner.switch(MODES[mode_dropdown.value])
+
+    def pause_button_click(e):
+        if runner.stepper is None:
+            return
+        if runner.paused:
+            runner.resume()
+            pause_button.text = "Pause"
+        else:
+            runner.pause()
+            pause_button.text = "Resume"
+        page.update()
+
+    def cancel_button_click(e):
+        runner.cancel()
+        left_column.controls[1] = img
+        status.value = ""
+        pause_button.text = "Pause"
+        page.update()
+
+    mode_dropdown.on_change = mode_changed
+
+    # Start, pause/resume, reset and cancel buttons
     start_button = ft.ElevatedButton(
         text="Start",
         on_click=start_button_click
     )
+    pause_button = ft.ElevatedButton(
+        text="Pause",
+        on_click=pause_button_click
+    )
+    reset_button = ft.ElevatedButton(
+        text="Reset",
+        on_click=lambda e: runner.reset() if runner.stepper is not None else None
+    )
+    cancel_button = ft.ElevatedButton(
+        text="Cancel",
+        on_click=cancel_button_click
+    )
 
     # Left column for title and image
     left_column = ft.Column(
         controls=[
             title,
             img,
+            status,
         ],
         expand=True,
         alignment=ft.MainAxisAlignment.CENTER,
@@ -113,6 +133,9 @@ def main(page: ft.Page):
         controls=[
             mode_dropdown,
             start_button,
+            pause_button,
+            reset_button,
+            cancel_button,
         ],
         expand=True,
         alignment=ft.MainAxisAlignment.SPACE_EVENLY,
@@ -134,6 +157,7 @@ def main(page: ft.Page):
     # Handle the window close event
     def window_event_handler(e):
         if e.data == "close":
+            runner.cancel()
             sys.exit()
 
     page.window_event_handler = window_event_handler
@@ -0,0 +1,119 @@
+import argparse
+import os
+import queue
+import threading
+
+import numpy as np
+
+
+# Path of the simulated times saved next to a snapshot stack
+def times_path(path):
+    root, _ = os.path.splitext(path)
+    return root + '.times.npy'
+
+
+# Streams decimated snapshots of a run into a preallocated, memory-mapped .npy
+# stack of shape (max_frames, *shape) from a background thread. Attach it to a
+# stepper with stepper.attach(writer, every_steps=k) or every_t=...; the
+# stepper thread only copies the field into one of `buffers` preallocated
+# buffers. When all buffers are still waiting to be written (or the stack is
+# full) the frame is dropped and counted in .dropped, so disk I/O never
+# stalls the stepper. close() writes the frame times to <name>.times.npy.
+class SnapshotWriter:
+    def __init__(self, path, shape, max_frames, dtype=np.float32, buffers=4):
+        self.path = path
+        self.frames = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                                shape=(max_frames,) + tuple(shape))
+        self.times = np.full(max_frames, np.nan)
+        self.count = 0
+        self.dropped = 0
+        self._free = queue.Queue()
+        for _ in range(buffers):
+            self._free.put(np.empty(shape, dtype))
+        self._pending = queue.Queue()
+        self._thread = threading.Thread(target=self._write_frames, daemon=True)
+        self._thread.start()
+
+    # Observer callback: queue a copy of the current field
+    def __call__(self, state):
+        if self.count >= len(self.frames):
+            self.dropped += 1
+            return
+        try:
+            buf = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        np.copyto(buf, state.field, casting='same_kind')
+        self._pending.put((self.count, state.t, buf))
+        self.count += 1
+
+    def _write_frames(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                break
+            index, t, buf = item
+            self.frames[index] = buf
+            self.times[index] = t
+            self._free.put(buf)
+
+    # Wait for the queued frames, flush the stack and save the frame times
+    def close(self):
+        if self._thread is None:
+            return
+        self._pending.put(None)
+        self._thread.join()
+        self._thread = None
+        self.frames.flush()
+        np.save(times_path(self.path), self.times[:self.count])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Open a snapshot stack lazily: returns (frames, times), where frames is a
+# read-only memory map of the written frames only
+def open_snapshots(path):
+    times = np.load(times_path(path))
+    frames = np.load(path, mmap_mode='r')[:len(times)]
+    return frames, times
+
+
+# Render a snapshot stack to an animated GIF, reading one frame at a time
+def make_gif(path, gif_path, fps=20, every=1, vmin=0, vmax=10):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import PillowWriter
+
+    frames, times = open_snapshots(path)
+    fig, ax = plt.subplots(figsize=(6, 6))
+    im = ax.imshow(frames[0], origin='lower', cmap='viridis', vmin=vmin, vmax=vmax)
+    fig.colorbar(im, ax=ax, label='Concentration')
+    writer = PillowWriter(fps=fps)
+    with writer.saving(fig, gif_path, dpi=80):
+        for k in range(0, len(frames), every):
+            im.set_data(frames[k])
+            ax.set_title(f'Pollutant Diffusion  t = {times[k]:.2f}')
+            writer.grab_frame()
+    plt.close(fig)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tools for snapshot stacks written by SnapshotWriter.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('gif', help='render a snapshot stack to an animated GIF')
+    p.add_argument('snapshots')
+    p.add_argument('gif')
+    p.add_argument('--fps', type=int, default=20)
+    p.add_argument('--every', type=int, default=1, help='use every n-th frame')
+    args = parser.parse_args(argv)
+    make_gif(args.snapshots, args.gif, fps=args.fps, every=args.every)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import threading
+import time
+
+import numpy as np
+from scipy import ndimage
+from scipy.fft import irfft2
+
+from render import downsample
+from solver import STEPPERS, State
+
+
+# Restriction: average factor x factor blocks (the last ones may be smaller)
+def restrict(field, factor):
+    return downsample(field, factor, 'mean')
+
+
+# Prolongation: bilinear interpolation of a cell-centred coarse field to shape
+def prolong(coarse, shape):
+    zoom = (shape[0] / coarse.shape[0], shape[1] / coarse.shape[1])
+    return ndimage.zoom(coarse, zoom, order=1, mode='nearest', grid_mode=True).astype(coarse.dtype, copy=False)
+
+
+# Keep the Fourier modes of an (nx, ny//2+1) half spectrum that a grid of
+# shape (cx, cy) can represent, rescaled for the smaller inverse transform
+def truncate_modes(u_hat, shape, coarse_shape):
+    cx, cy = coarse_shape
+    low, high = (cx + 1) // 2, cx // 2
+    rows = np.r_[0:low, u_hat.shape[0] - high:u_hat.shape[0]]
+    return u_hat[rows, :cy // 2 + 1] * (cx * cy / (shape[0] * shape[1]))
+
+
+# Grid shape of a stepper, without transforming a stale spectral field
+def _grid_shape(stepper):
+    return stepper.shape if stepper.name == 'spectral' else stepper.state.field.shape[-2:]
+
+
+# A stepper of the same kind on a grid coarsened by factor (1 gives an
+# independent copy), at the same simulated time. Grid steppers get the
+# restricted field and dt * factor^2, which keeps D dt / dx^2 and with it the
+# explicit stability margin; the spectral stepper keeps the low modes. Its
+# field is computed by an inverse transform on the coarse grid only.
+def coarsen(stepper, factor):
+    s = stepper.state
+    if type(stepper) not in STEPPERS.values():
+        raise ValueError(f'cannot coarsen a {type(stepper).__name__}')
+    if np.ndim(s.D) or (s.u_hat if s.u_hat is not None else s.field).ndim != 2:
+        raise ValueError('progressive previews need a single 2-D field, not an ensemble')
+    nx, ny = _grid_shape(stepper)
+    if factor == 1:
+        field = s.field.copy()
+    elif stepper.name == 'spectral':
+        coarse_shape = (max(nx // factor, 2), max(ny // factor, 2))
+        field = irfft2(truncate_modes(s.u_hat, (nx, ny), coarse_shape), s=coarse_shape).astype(stepper.dtype)
+    else:
+        field = restrict(s.field, factor)
+    cx, cy = field.shape
+    state = State(field, s.dx * nx / cx, s.dy * ny / cy, s.D, s.dt * factor**2)
+    state.t, state.step = s.t, s.step
+    coarse = type(stepper)(state, **stepper.options())
+    coarse.pending = stepper.pending.copy()
+    return coarse
+
+
+# Advance a stepper to exactly t_end, shortening dt so that whole steps land on it
+def _run_to(stepper, t_end):
+    s = stepper.state
+    n_steps = int(np.ceil((t_end - s.t) / s.dt - 1e-9))
+    if n_steps > 0:
+        s.dt = (t_end - s.t) / n_steps
+        stepper.advance(n_steps)
+
+
+# Progressive answers to "what will the lake look like at t_end" (e.g. right
+# after a source was added). frames() runs the scenario on grids
+# coarsened by each factor in turn (restricted from the current field, or
+# with the spectral modes truncated) and yields each coarse result as soon as
+# it is ready; 16x coarser explicit grids take 16^4 times less work. For the
+# grid steppers a refined full-resolution frame follows: the finest coarse
+# state smooth_steps steps before t_end is prolongated and finished with
+# smooth_steps fine steps, which damp the interpolation error. start()
+# computes the exact result on a copy in a background thread; adopt() moves
+# the original stepper to it once done. Interactive loops call poll() once
+# per frame instead, which steps through all of this without blocking.
+#   preview = ProgressivePreview(stepper, state.t + 50)
+#   for factor, field in preview.frames():
+#       renderer.update(field)   # smaller fields are stretched over the extent
+#   preview.start()
+#   ...
+#   if preview.done:
+#       preview.adopt()
+class ProgressivePreview:
+    def __init__(self, stepper, t_end, factors=(16, 4), smooth_steps=4, min_cells=16):
+        self.stepper = stepper
+        self.t_end = t_end
+        n = min(_grid_shape(stepper))
+        self.factors = sorted((f for f in factors if f > 1 and n // f >= min_cells), reverse=True)
+        self.smooth_steps = smooth_steps
+        self.timings = []      # (factor, seconds) of every frame
+        self.finished = False  # Set once poll() returned the exact result
+        self._frames = None
+        self._exact = None
+        self._thread = None
+        self._cancelled = False
+
+    def frames(self):
+        t_end = self.t_end
+        s = self.stepper.state
+        spectral = self.stepper.name == 'spectral'
+        for k, factor in enumerate(self.factors):
+            start = time.perf_counter()
+            coarse = coarsen(self.stepper, factor)
+            finest = k == len(self.factors) - 1
+            tau = self.smooth_steps * s.dt
+            smooth = finest and not spectral and self.smooth_steps > 0 and t_end - s.t > tau
+            if smooth:
+                _run_to(coarse, t_end - tau)
+                warm = coarse.state.field.copy()
+            _run_to(coarse, t_end)
+            self.timings.append((factor, time.perf_counter() - start))
+            yield factor, coarse.state.field
+            if smooth:
+                start = time.perf_counter()
+                fine = coarsen(self.stepper, 1)
+                fine.state.field = prolong(warm, _grid_shape(self.stepper))
+                fine.state.t = t_end - tau
+                fine.refresh()
+                _run_to(fine, t_end)
+                self.timings.append((1, time.perf_counter() - start))
+                yield 1, fine.state.field
+
+    # Compute the exact result at t_end on a copy of the stepper in a
+    # background thread
+    def start(self, chunk=10):
+        self._exact = coarsen(self.stepper, 1)
+        self._cancelled = False
+
+        def run():
+            exact = self._exact
+            while not self._cancelled and exact.state.t < self.t_end - 1e-9 * exact.state.dt:
+                remaining = int(np.ceil((self.t_end - exact.state.t) / exact.state.dt - 1e-9))
+                exact.advance(min(chunk, remaining))
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    @property
+    def done(self):
+        return self._thread is not None and not self._thread.is_alive() and not self._cancelled
+
+    # Exact field at t_end (waits for the background run)
+    def result(self):
+        self._thread.join()
+        return self._exact.state.field
+
+    # Move the original stepper to the exact result
+    def adopt(self):
+        field = self.result()
+        s, exact = self.stepper.state, self._exact.state
+        s.field = field
+        s.t, s.step = exact.t, exact.step
+        self.stepper.pending = self._exact.pending
+        self.stepper.refresh()
+
+    # Next field to show in an interactive loop: the coarse frames in turn,
+    # then None while the exact result is computed and finally the exact
+    # result, which the stepper adopts
+    def poll(self):
+        if self._thread is None:
+            if self._frames is None:
+                self._frames = self.frames()
+            frame = next(self._frames, None)
+            if frame is not None:
+                return frame[1]
+            self.start()
+        if self.finished or not self.done:
+            return None
+        self.adopt()
+        self.finished = True
+        return self.stepper.state.field
+
+    def cancel(self):
+        self._cancelled = True
+        if self._thread is not None:
+            self._thread.join()
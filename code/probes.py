@@ -0,0 +1,98 @@
+import numpy as np
+
+INTERPOLATIONS = ('nearest', 'bilinear')
+
+
+# Records concentration time series at fixed sensor points while a stepper
+# advances, without storing snapshots. points are (x, y) pairs in physical
+# units like source events (x along field axis 1, y along axis 0). The grid
+# indices and interpolation weights are computed once; each sample is one
+# vectorized gather into a preallocated ring buffer holding the last
+# `capacity` samples. 'nearest' reads the cell containing each point (as the
+# scripts' right click does), 'bilinear' interpolates between the four
+# surrounding grid points. While a spectral stepper's real-space field is
+# stale, a few probes' grid values are evaluated straight from the Fourier
+# coefficients, so no inverse transform is needed.
+#   recorder = ProbeRecorder(stepper, [(50, 50), (120, 80)])
+#   stepper.advance(1000)
+#   t, values = recorder.series()   # values[k, p] (or [k, member, p])
+class ProbeRecorder:
+    def __init__(self, stepper, points, capacity=10000, interpolation='nearest', every_steps=1):
+        if interpolation not in INTERPOLATIONS:
+            raise ValueError(f'unknown interpolation {interpolation!r} (expected one of {INTERPOLATIONS})')
+        s = stepper.state
+        self.stepper = stepper
+        self.points = np.asarray(points, float).reshape(-1, 2)
+        self.interpolation = interpolation
+        field = s.field
+        nx, ny = field.shape[-2:]
+        fi = self.points[:, 1] / s.dx
+        fj = self.points[:, 0] / s.dy
+        outside = (fi < 0) | (fi > nx - 1) | (fj < 0) | (fj > ny - 1)
+        if outside.any():
+            raise ValueError(f'probe point {tuple(self.points[outside][0])} lies outside the grid')
+
+        if interpolation == 'nearest':
+            i, j = fi.astype(int), fj.astype(int)
+            self._index = (i * ny + j)[:, None]
+            self._weights = np.ones((len(i), 1), field.dtype)
+        else:
+            i = np.minimum(fi.astype(int), nx - 2)
+            j = np.minimum(fj.astype(int), ny - 2)
+            a, b = fi - i, fj - j
+            self._index = np.stack([i * ny + j, (i + 1) * ny + j, i * ny + j + 1, (i + 1) * ny + j + 1], axis=1)
+            self._weights = np.stack([(1 - a) * (1 - b), a * (1 - b), (1 - a) * b, a * b],
+                                     axis=1).astype(field.dtype)
+
+        # Inverse real DFT at the probed grid points: u = Re(Ex @ u_hat @ Ey) / (nx ny),
+        # with the half-spectrum columns other than 0 (and ny/2) counted twice.
+        # Only used while it is cheaper than a full inverse transform (rough
+        # flop counts as in SpectralStepper._add_sources); many probes (or
+        # bilinear corners) read the transformed field instead.
+        self._Ex = self._Ey = None
+        fourier_cost = self._index.size * nx * (ny // 2 + 1)
+        if s.u_hat is not None and fourier_cost <= 2 * nx * ny * np.log2(nx * ny):
+            ci, cj = self._index.ravel() // ny, self._index.ravel() % ny
+            ky = np.arange(ny // 2 + 1)
+            weight = np.where((ky == 0) | (2 * ky == ny), 1.0, 2.0)
+            self._Ex = _roots(nx)[np.outer(ci, np.arange(nx)) % nx] / (nx * ny)
+            self._Ey = _roots(ny)[np.outer(cj, ky) % ny] * weight
+
+        self.times = np.full(capacity, np.nan)
+        self.values = np.zeros((capacity,) + field.shape[:-2] + (len(self.points),), field.dtype)
+        self.count = 0
+        self.observer = stepper.attach(self, every_steps=every_steps)
+        self(s)
+
+    # Observer callback: record one sample of all probes
+    def __call__(self, state):
+        k = self.count % len(self.times)
+        if state._field is None and self._Ex is not None:
+            coeffs = self._Ex @ state.u_hat  # (..., probes * corners, ny//2+1)
+            grid = np.einsum('...cm,cm->...c', coeffs, self._Ey).real
+            grid = grid.reshape(grid.shape[:-1] + self._index.shape)
+        else:
+            field = state.field.reshape(state.field.shape[:-2] + (-1,))
+            grid = np.take(field, self._index, axis=-1)
+        np.einsum('...pk,pk->...p', grid, self._weights, out=self.values[k], casting='same_kind')
+        self.times[k] = state.t
+        self.count += 1
+
+    # Recorded samples in time order: (times, values), values[k, ..., p]
+    def series(self):
+        n = min(self.count, len(self.times))
+        order = np.arange(self.count - n, self.count) % len(self.times)
+        return self.times[order], self.values[order]
+
+    # Save the points and the recorded series to an .npz file
+    def save(self, path):
+        times, values = self.series()
+        np.savez(path, points=self.points, t=times, values=values)
+
+    def detach(self):
+        self.stepper.detach(self.observer)
+
+
+# exp(2 pi i k / n) for k = 0..n-1
+def _roots(n):
+    return np.exp(2j * np.pi * np.arange(n) / n)
@@ -0,0 +1,138 @@
+import json
+import time
+
+
+# Wall time accumulated by one named phase of a main loop (not re-entrant)
+class _Phase:
+    __slots__ = ('total', 'calls', 'start')
+
+    def __init__(self):
+        self.total = 0.0
+        self.calls = 0
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.total += time.perf_counter() - self.start
+        self.calls += 1
+
+
+# Shared do-nothing phase handed out while the profiler is disabled
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_PHASE = _NullPhase()
+
+
+# Low-overhead instrumentation for the simulation loops:
+#   with profiler.phase('step'):
+#       stepper.advance(steps_per_frame)
+#   profiler.count('steps', steps_per_frame)
+#   profiler.tick()   # once per loop iteration
+# phase() times a block, count() bumps a counter (rates are reported per
+# second), and tick() refreshes the optional on-canvas overlay (steps/s, FPS
+# and ms per phase over the last overlay_every seconds) and appends a summary
+# line to the JSON-lines file dump_path every dump_every seconds. When the
+# profiler is disabled every call returns immediately.
+class Profiler:
+    def __init__(self, enabled=True, dump_path=None, dump_every=10.0, overlay_every=0.5):
+        self.enabled = enabled
+        self.dump_path = dump_path
+        self.dump_every = dump_every
+        self.overlay_every = overlay_every
+        self.phases = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+        self._text = None
+        self._last_dump = self.start
+        self._window = self._snapshot(self.start)
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = _Phase()
+        return phase
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    # Show the overlay in the corner of a matplotlib axes
+    def attach_overlay(self, ax):
+        if self.enabled:
+            self._text = ax.text(0.02, 0.98, '', transform=ax.transAxes, va='top', ha='left',
+                                 family='monospace', fontsize=8, color='white', zorder=10,
+                                 bbox=dict(boxstyle='round,pad=0.3', facecolor='black', alpha=0.5))
+        return self._text
+
+    def tick(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._text is not None and now - self._window[0] >= self.overlay_every:
+            self._text.set_text(self._overlay_text(now))
+        if self.dump_path and now - self._last_dump >= self.dump_every:
+            self.dump()
+
+    def _snapshot(self, now):
+        return (now, dict(self.counters),
+                {name: (p.total, p.calls) for name, p in self.phases.items()})
+
+    # Rates and mean ms per call since the previous overlay refresh
+    def _overlay_text(self, now):
+        t0, counters, phases = self._window
+        self._window = self._snapshot(now)
+        span = now - t0
+        lines = [f'{name}/s {(n - counters.get(name, 0)) / span:9.1f}'
+                 for name, n in self.counters.items()]
+        for name, p in self.phases.items():
+            total, calls = phases.get(name, (0.0, 0))
+            if p.calls > calls:
+                lines.append(f'{name:<8} {1e3 * (p.total - total) / (p.calls - calls):7.2f} ms')
+        return '\n'.join(lines)
+
+    # Totals since the profiler was created
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            'elapsed_s': elapsed,
+            'counters': dict(self.counters),
+            'rates': {name: n / elapsed for name, n in self.counters.items()},
+            'phases': {name: {'calls': p.calls, 'total_s': p.total,
+                              'mean_ms': 1e3 * p.total / p.calls if p.calls else 0.0,
+                              'share': p.total / elapsed}
+                       for name, p in self.phases.items()},
+        }
+
+    # Append the current summary to dump_path (or path) as one JSON line
+    def dump(self, path=None):
+        self._last_dump = time.perf_counter()
+        with open(path or self.dump_path, 'a') as f:
+            f.write(json.dumps({'time': time.time(), **self.summary()}) + '\n')
+
+    def report(self):
+        s = self.summary()
+        lines = [f'{s["elapsed_s"]:.1f} s: '
+                 + ', '.join(f'{n} {name} ({s["rates"][name]:.1f}/s)'
+                             for name, n in s['counters'].items())]
+        for name, p in s['phases'].items():
+            lines.append(f'  {name:<8} {p["calls"]:8d} calls {p["mean_ms"]:8.3f} ms '
+                         f'{100 * p["share"]:5.1f}%')
+        return '\n'.join(lines)
+
+    # Final dump at the end of a session
+    def close(self):
+        if self.enabled and self.dump_path:
+            self.dump()
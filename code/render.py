@@ -0,0 +1,113 @@
+import math
+import time
+
+import numpy as np
+
+REDUCTIONS = ('max', 'mean')
+
+
+# Shrink a field by an integer factor for display, reducing blocks of
+# factor x factor cells (the last blocks may be smaller) to their maximum, so
+# small plumes stay visible, or to their mean
+def downsample(field, factor, reduce='max'):
+    if reduce not in REDUCTIONS:
+        raise ValueError(f'unknown reduction {reduce!r} (expected one of {REDUCTIONS})')
+    if factor <= 1:
+        return field
+    rows = np.arange(0, field.shape[0], factor)
+    cols = np.arange(0, field.shape[1], factor)
+    if reduce == 'max':
+        return np.maximum.reduceat(np.maximum.reduceat(field, rows, axis=0), cols, axis=1)
+    sums = np.add.reduceat(np.add.reduceat(field, rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.r_[rows, field.shape[0]]), np.diff(np.r_[cols, field.shape[1]]))
+    return (sums / counts).astype(field.dtype, copy=False)
+
+
+# Map a field to 8-bit levels over [vmin, vmax] (the colour range of the
+# scripts), clipping values outside it
+def quantize(field, vmin=0, vmax=10):
+    levels = np.subtract(field, vmin, dtype=np.float32)
+    levels *= 255 / (vmax - vmin)
+    levels += 0.5
+    np.clip(levels, 0, 255, out=levels)
+    return levels.astype(np.uint8)
+
+
+# 256-entry RGB lookup table of a matplotlib colormap, for colouring
+# quantize() levels without a figure
+def colormap_lut(name='viridis'):
+    from matplotlib import colormaps
+    return (colormaps[name](np.arange(256))[:, :3] * 255 + 0.5).astype(np.uint8)
+
+
+# Largest downsampling factor that still leaves at least one cell per screen
+# pixel of the axes
+def display_factor(ax, shape):
+    height, width = ax.bbox.height, ax.bbox.width
+    if height < 1 or width < 1:
+        return 1
+    return max(1, math.floor(min(shape[0] / height, shape[1] / width)))
+
+
+# Render a field into an imshow image at most fps times per second,
+# independently of how many solver steps run in between:
+#   renderer = FieldRenderer(im, artists=[annotation])
+#   while running:
+#       stepper.advance(steps_per_frame)
+#       if renderer.due():
+#           renderer.update(state.field)
+#           fig.canvas.flush_events()
+# On canvases that support it only the image and the given artists are
+# redrawn (blitted) over a cached background; the axes, colorbar and widgets
+# are drawn only on full redraws (resize, slider moves). Fields larger than
+# the axes are downsampled to about one cell per pixel before imshow
+# resamples them.
+class FieldRenderer:
+    def __init__(self, im, fps=30, reduce='max', artists=()):
+        if reduce not in REDUCTIONS:
+            raise ValueError(f'unknown reduction {reduce!r} (expected one of {REDUCTIONS})')
+        self.im = im
+        self.ax = im.axes
+        self.canvas = im.figure.canvas
+        self.fps = fps
+        self.reduce = reduce
+        self.artists = [im] + [artist for artist in artists if artist is not None]
+        self.frames = 0
+        self.factor = display_factor(self.ax, im.get_array().shape)
+        self.blit = self.canvas.supports_blit
+        self._shape = im.get_array().shape
+        self._background = None
+        self._next = 0.0
+        if self.blit:
+            for artist in self.artists:
+                artist.set_animated(True)
+            self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    # Full redraw: cache the new background and put the animated artists back
+    def _on_draw(self, event):
+        self.factor = display_factor(self.ax, self._shape)
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    # Whether the next frame is due under the fps cap
+    def due(self):
+        return time.perf_counter() >= self._next
+
+    # Show field now (e.g. after a click) and restart the frame interval
+    def update(self, field):
+        self._next = time.perf_counter() + 1 / self.fps
+        if field.shape != self._shape:
+            self._shape = field.shape
+            self.factor = display_factor(self.ax, field.shape)
+        self.im.set_data(downsample(field, self.factor, self.reduce))
+        if self.blit and self._background is not None:
+            self.canvas.restore_region(self._background)
+            self._draw_artists()
+            self.canvas.blit(self.ax.bbox)
+        else:
+            self.canvas.draw_idle()
+        self.frames += 1
@@ -0,0 +1,128 @@
+import base64
+import io
+import queue
+import threading
+import time
+
+from PIL import Image
+
+import render
+from solver import default_stepper
+
+
+# Runs a scenario in a background thread of the calling process and hands
+# PNG frames (base64, as used by ft.Image.src_base64) to on_frame(image,
+# stepper) at most fps times per second, so a GUI thread never blocks on the
+# solver. Solver state is only touched by the worker thread: controls from
+# other threads are queued and run between steps. Switching methods builds a
+# new default scenario in the already warm process, which takes milliseconds.
+#   runner = SimulationRunner(show_frame)
+#   runner.start('fd'); runner.pause(); runner.resume(); runner.switch('spectral')
+#   runner.add_source(0.5, 0.5); runner.cancel()
+class SimulationRunner:
+    def __init__(self, on_frame, fps=15, steps_per_frame=1, max_pixels=400,
+                 vmin=0, vmax=10, cmap='viridis'):
+        self.on_frame = on_frame
+        self.fps = fps
+        self.steps_per_frame = steps_per_frame
+        self.max_pixels = max_pixels
+        self.vmin, self.vmax = vmin, vmax
+        self.stepper = None
+        self.paused = False
+        self._lut = render.colormap_lut(cmap)
+        self._commands = queue.Queue()
+        self._cancelled = False
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and not self.paused
+
+    # Start the worker with a method (or switch an active worker to it)
+    def start(self, method):
+        self.switch(method)
+        self.resume()
+        if self._thread is None:
+            self._cancelled = False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def switch(self, method):
+        self._commands.put(lambda: self._load(method))
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._commands.put(lambda: None)  # wake a paused worker
+
+    def reset(self):
+        self._commands.put(lambda: self.stepper.reset())
+
+    # Add a source at a position given as fractions of the frame width and
+    # height from its top-left corner (e.g. a tap on the image)
+    def add_source(self, fx, fy, radius=5, concentration=10):
+        self._commands.put(lambda: self._add_source(fx, fy, radius, concentration))
+
+    # Stop the worker and wait for it; the runner can be started again
+    def cancel(self):
+        if self._thread is None:
+            return
+        self._cancelled = True
+        self._commands.put(lambda: None)
+        self._thread.join()
+        self._thread = None
+        self._load(None)
+
+    def _load(self, method):
+        if self.stepper is not None and hasattr(self.stepper, 'close'):
+            self.stepper.close()
+        self.stepper = default_stepper(method) if method is not None else None
+
+    def _add_source(self, fx, fy, radius, concentration):
+        s = self.stepper.state
+        nx, ny = s.shape[-2:]
+        i = min(int((1 - fy) * nx), nx - 1)  # frames are shown with row 0 at the bottom
+        j = min(int(fx * ny), ny - 1)
+        # As in the scripts: the spectral one adds to the field, the others set it
+        mode = 'add' if self.stepper.name == 'spectral' else 'set'
+        self.stepper.add_sources(i, j, radius, concentration, mode=mode)
+
+    # Run queued commands; waits for one while paused. Returns whether any ran.
+    def _run_commands(self):
+        ran = False
+        while True:
+            try:
+                if self.paused and not ran:
+                    command = self._commands.get(timeout=0.1)
+                else:
+                    command = self._commands.get_nowait()
+            except queue.Empty:
+                return ran
+            command()
+            ran = True
+
+    def _run(self):
+        next_frame = 0.0
+        while True:
+            changed = self._run_commands()
+            if self._cancelled:
+                break
+            if not self.paused:
+                self.stepper.advance(self.steps_per_frame)
+                changed = True
+            now = time.perf_counter()
+            if changed and (now >= next_frame or self.paused):
+                next_frame = now + 1 / self.fps
+                self.on_frame(self.encode(), self.stepper)
+
+    # Current field as a base64 PNG, coloured over [vmin, vmax] like the
+    # scripts and max-pooled down to about max_pixels per side
+    def encode(self):
+        field = self.stepper.state.field
+        factor = max(1, min(field.shape) // self.max_pixels)
+        levels = render.quantize(render.downsample(field, factor), self.vmin, self.vmax)
+        buffer = io.BytesIO()
+        Image.fromarray(self._lut[levels[::-1]]).save(buffer, format='PNG', compress_level=1)
+        return base64.b64encode(buffer.getvalue()).decode('ascii')
@@ -0,0 +1,438 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import render
+import sources
+from solver import STEPPERS, default_stepper
+
+# Wire format (TCP). Server to client, per frame: a big-endian uint32 length
+# and a JSON header {"frame", "t", "shape": [h, w], "tile", "tiles", "key",
+# "extent", "vmin", "vmax"}, then a uint32 length and the zlib-compressed
+# payload: the big-endian uint32 indices (row-major over the tile grid) of
+# the tiles sent, followed by their tile x tile uint8 levels. A key frame
+# holds all tiles, the others only those that changed since the last frame
+# sent to that client. Client to server: one JSON command per line,
+# {"cmd": "source", "x", "y", "radius", "concentration", "mode"} (x, y in
+# the physical units of the extent, radius in cells, mode optional) or
+# {"cmd": "reset"}. Invalid commands are dropped; a line longer than the
+# stream limit (64 KiB) closes the connection.
+_LENGTH = struct.Struct('>I')
+
+log = logging.getLogger(__name__)
+
+
+# Source event of a client's "source" command; raises ValueError unless x
+# and y are numbers inside the grid extent, radius (in cells, default 5) and
+# concentration (default 10) are numbers and mode, if given, is a known one
+def _source_events(stepper, command):
+    s = stepper.state
+    for name in ('x', 'y'):
+        if name not in command:
+            raise ValueError(f'source command without {name}')
+    values = {'radius': 5, 'concentration': 10, **command}
+    for name in ('x', 'y', 'radius', 'concentration'):
+        value = values[name]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f'{name} must be a finite number, got {value!r}')
+    nx, ny = s.field.shape[-2:]
+    if not (0 <= values['x'] <= ny * s.dy and 0 <= values['y'] <= nx * s.dx):
+        raise ValueError(f'source at ({values["x"]}, {values["y"]}) outside the extent '
+                         f'[0, {ny * s.dy}] x [0, {nx * s.dx}]')
+    if values['radius'] < 0:
+        raise ValueError(f'radius must not be negative, got {values["radius"]}')
+    # As in the scripts: the spectral one adds to the field, the others set it
+    mode = command.get('mode', 'add' if stepper.name == 'spectral' else 'set')
+    if mode not in sources.MODES:
+        raise ValueError(f'unknown source mode {mode!r} (expected one of {sources.MODES})')
+    events = np.zeros(1, sources.EVENT_DTYPE)
+    events['x'], events['y'] = values['x'], values['y']
+    events['radius'] = values['radius'] * s.dx
+    events['concentration'] = values['concentration']
+    events['mode'] = mode
+    return events
+
+
+# A published frame: 8-bit levels padded to whole tiles
+class _Frame:
+    __slots__ = ('number', 't', 'levels', 'shape', 'extent')
+
+    def __init__(self, number, t, levels, shape, extent):
+        self.number, self.t, self.levels, self.shape, self.extent = number, t, levels, shape, extent
+
+
+# Encode frame as a message, with only the tiles that differ from previous
+# (padded levels of the same shape, or None for a key frame)
+def encode_frame(frame, previous, tile, vmin, vmax, level=1):
+    h, w = frame.levels.shape
+    tiles = frame.levels.reshape(h // tile, tile, w // tile, tile).swapaxes(1, 2)
+    if previous is None:
+        index = np.arange(tiles.shape[0] * tiles.shape[1])
+    else:
+        before = previous.reshape(tiles.shape[0], tile, tiles.shape[1], tile).swapaxes(1, 2)
+        index = np.flatnonzero((tiles != before).any(axis=(2, 3)))
+    changed = tiles.reshape(-1, tile, tile)[index]
+    payload = zlib.compress(index.astype('>u4').tobytes() + changed.tobytes(), level)
+    header = json.dumps({
+        'frame': frame.number, 't': frame.t, 'shape': list(frame.shape), 'tile': tile,
+        'tiles': len(index), 'key': previous is None, 'extent': frame.extent,
+        'vmin': vmin, 'vmax': vmax,
+    }).encode()
+    return b''.join((_LENGTH.pack(len(header)), header, _LENGTH.pack(len(payload)), payload))
+
+
+# Apply a decoded message to the client's padded levels (None before the
+# first key frame); returns the updated levels
+def decode_frame(header, payload, levels=None):
+    tile, (h, w) = header['tile'], header['shape']
+    padded = (h + -h % tile, w + -w % tile)
+    if header['key'] or levels is None or levels.shape != padded:
+        levels = np.zeros(padded, np.uint8)
+    data = zlib.decompress(payload)
+    n = header['tiles']
+    index = np.frombuffer(data, '>u4', n)
+    changed = np.frombuffer(data, np.uint8, offset=4 * n).reshape(n, tile, tile)
+    tiles = levels.reshape(padded[0] // tile, tile, padded[1] // tile, tile).swapaxes(1, 2)
+    columns = padded[1] // tile
+    tiles[index // columns, index % columns] = changed
+    return levels
+
+
+# Per-connection state of the server
+class _Client:
+    def __init__(self, address):
+        self.address = address
+        self.wake = asyncio.Event()
+        self.closed = False
+        self.last = None    # Last frame sent
+        self.sent = 0
+        self.dropped = 0    # Frames skipped because the client was still busy
+        self.bytes = 0
+
+
+# Streams frames of a running simulation to any number of viewers over TCP
+# from an asyncio loop in a background thread, so the solver loop only pays
+# for quantizing a frame. publish(state) maps the field to 8-bit levels over
+# [vmin, vmax] (the scripts' colour range), max-pooled to about max_pixels
+# per side, at most fps times per second. Each client is sent the newest
+# frame as soon as it has taken the previous one: frames published while a
+# slow client is still draining are dropped for that client only, and the
+# delta is always taken against what that client last received. Each
+# connection buffers at most about send_buffer bytes (socket and transport),
+# which bounds how far behind a slow client can fall. Deltas are
+# computed and compressed on worker threads and shared between clients in
+# the same position. Commands from clients are queued and applied by
+# apply_commands(stepper) in the solver thread, between steps.
+#   server = FrameServer(port=8765).start()
+#   server.attach(stepper)      # or call publish()/apply_commands() yourself
+#   while True:
+#       stepper.advance(10)
+class FrameServer:
+    def __init__(self, host='127.0.0.1', port=8765, fps=15, tile=32, max_pixels=1024,
+                 vmin=0, vmax=10, level=1, send_buffer=64 * 1024):
+        if tile < 1 or fps <= 0:
+            raise ValueError(f'need tile >= 1 and fps > 0, got {tile} and {fps}')
+        self.host, self.port = host, port
+        self.fps, self.tile, self.max_pixels = fps, tile, max_pixels
+        self.vmin, self.vmax, self.level = vmin, vmax, level
+        self.send_buffer = send_buffer
+        self.published = 0
+        self.clients = []
+        self.commands = queue.Queue()
+        self._latest = None
+        self._encoded = {}
+        self._next = 0.0
+        self._loop = None
+        self._stop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    # Start listening (port=0 picks a free port, see self.port); returns self
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return self
+
+    def _run(self):
+        try:
+            asyncio.run(self._serve())
+        except OSError as error:
+            self._error = error
+            self._ready.set()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await self._stop.wait()
+            for client in self.clients:
+                client.closed = True
+                client.wake.set()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+        self._thread = None
+
+    # Whether the next frame is due under the fps cap
+    def due(self):
+        return time.perf_counter() >= self._next
+
+    # Publish the current field (solver thread); never waits for clients
+    def publish(self, state):
+        self._next = time.perf_counter() + 1 / self.fps
+        field = state.field
+        factor = max(1, min(field.shape) // self.max_pixels)
+        levels = render.quantize(render.downsample(field, factor), self.vmin, self.vmax)
+        T = self.tile
+        padded = np.pad(levels, ((0, -levels.shape[0] % T), (0, -levels.shape[1] % T)))
+        nx, ny = field.shape
+        frame = _Frame(self.published, float(state.t), padded, levels.shape,
+                       [0, ny * state.dy, 0, nx * state.dx])
+        self.published += 1
+        self._loop.call_soon_threadsafe(self._post, frame)
+
+    def _post(self, frame):
+        self._latest = frame
+        self._encoded.clear()
+        for client in self.clients:
+            client.wake.set()
+
+    # Apply queued client commands to stepper (solver thread); returns how
+    # many were applied, e.g. to wake a SteadyState. Invalid commands are
+    # logged and dropped, so a client cannot stop the solver.
+    def apply_commands(self, stepper):
+        applied = 0
+        while True:
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                return applied
+            try:
+                if command.get('cmd') == 'reset':
+                    stepper.reset()
+                elif command.get('cmd') == 'source':
+                    stepper.apply_events(_source_events(stepper, command))
+                else:
+                    raise ValueError(f'unknown command {command.get("cmd")!r} (expected source or reset)')
+            except (KeyError, TypeError, ValueError) as error:
+                log.warning('dropped client command %r: %s', command, error)
+                continue
+            applied += 1
+
+    # Observer that applies commands every every_steps steps and publishes
+    # frames when due; returns the handle for stepper.detach()
+    def attach(self, stepper, every_steps=1):
+        def observe(state):
+            self.apply_commands(stepper)
+            if self.due():
+                self.publish(state)
+        return stepper.attach(observe, every_steps=every_steps)
+
+    async def _encode(self, last, frame):
+        previous = last if last is not None and last.levels.shape == frame.levels.shape else None
+        key = (previous.number if previous is not None else None, frame.number)
+        future = self._encoded.get(key)
+        if future is None:
+            future = self._encoded[key] = self._loop.run_in_executor(
+                None, encode_frame, frame, previous.levels if previous is not None else None,
+                self.tile, self.vmin, self.vmax, self.level)
+        return await future
+
+    async def _receive(self, reader, client):
+        try:
+            async for line in reader:
+                try:
+                    command = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(command, dict):
+                    self.commands.put(command)
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError) as error:
+            # ValueError includes the LimitOverrunError of an over-long line
+            log.warning('closing client %s: %s', client.address, error)
+        client.closed = True
+        client.wake.set()
+
+    async def _handle(self, reader, writer):
+        client = _Client(writer.get_extra_info('peername'))
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        writer.transport.set_write_buffer_limits(high=self.send_buffer)
+        self.clients.append(client)
+        receiver = asyncio.create_task(self._receive(reader, client))
+        try:
+            if self._latest is not None:
+                client.wake.set()
+            while True:
+                await client.wake.wait()
+                client.wake.clear()
+                frame = self._latest
+                if client.closed:
+                    break
+                if frame is None or (client.last is not None and frame.number == client.last.number):
+                    continue
+                data = await self._encode(client.last, frame)
+                writer.write(data)
+                await writer.drain()
+                if client.last is not None:
+                    client.dropped += frame.number - client.last.number - 1
+                client.last = frame
+                client.sent += 1
+                client.bytes += len(data)
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError) as error:
+            log.warning('closing client %s: %s', client.address, error)
+        finally:
+            self.clients.remove(client)
+            receiver.cancel()
+            writer.close()
+
+
+# Blocking client of a FrameServer. A small receive buffer keeps a slow
+# viewer close to the newest frame (the server skips frames instead):
+#   client = FrameClient('127.0.0.1', 8765)
+#   header, levels = client.receive()   # uint8 levels, header['vmin'..'vmax']
+#   client.add_source(50.0, 50.0)
+class FrameClient:
+    def __init__(self, host='127.0.0.1', port=8765, receive_buffer=64 * 1024):
+        self._socket = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self._socket.connect((host, port))
+        self._file = self._socket.makefile('rb')
+        self._levels = None
+        self.bytes = 0
+
+    def _read(self):
+        head = self._file.read(_LENGTH.size)
+        if len(head) < _LENGTH.size:
+            raise ConnectionError('server closed the connection')
+        data = self._file.read(_LENGTH.unpack(head)[0])
+        self.bytes += len(head) + len(data)
+        return data
+
+    # Wait for the next frame; returns its header and the levels
+    def receive(self):
+        header = json.loads(self._read())
+        self._levels = decode_frame(header, self._read(), self._levels)
+        h, w = header['shape']
+        return header, self._levels[:h, :w]
+
+    def send(self, command):
+        self._socket.sendall(json.dumps(command).encode() + b'\n')
+
+    # Add a source at (x, y) in the units of the frame extent, radius in cells
+    def add_source(self, x, y, radius=5, concentration=10):
+        self.send({'cmd': 'source', 'x': x, 'y': y, 'radius': radius, 'concentration': concentration})
+
+    def reset(self):
+        self.send({'cmd': 'reset'})
+
+    # Also ends a receive() waiting in another thread
+    def close(self):
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._file.close()
+        self._socket.close()
+
+
+def serve(args):
+    stepper = default_stepper(args.method)
+    server = FrameServer(args.host, args.port, fps=args.fps, tile=args.tile,
+                         max_pixels=args.max_pixels).start()
+    server.attach(stepper, every_steps=args.steps_per_frame)
+    print(f'{stepper.name}: serving frames on {args.host}:{server.port} (Ctrl-C to stop)')
+    try:
+        while True:
+            stepper.advance(args.steps_per_frame)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for client in list(server.clients):
+            print(f'{client.address}: {client.sent} frames sent, {client.dropped} dropped, '
+                  f'{client.bytes / 1024:.0f} KB')
+        server.close()
+    print(f'{server.published} frames published, t={stepper.state.t:.4g}')
+
+
+# Matplotlib viewer: frames are received on a background thread; left
+# clicks add sources with the given radius and concentration
+def view(args):
+    import matplotlib.pyplot as plt
+    host, port = args.address.rsplit(':', 1)
+    client = FrameClient(host, int(port))
+    latest = [None]
+
+    def receive():
+        try:
+            while True:
+                latest[0] = client.receive()
+        except (ConnectionError, OSError):
+            latest[0] = None
+
+    threading.Thread(target=receive, daemon=True).start()
+    while latest[0] is None:
+        time.sleep(0.01)
+    header, levels = latest[0]
+    fig, ax = plt.subplots()
+    im = ax.imshow(levels, extent=header['extent'], origin='lower', cmap='viridis', vmin=0, vmax=255)
+    title = ax.set_title('')
+
+    def onclick(event):
+        if event.inaxes is ax and event.button == 1:
+            client.add_source(event.xdata, event.ydata, args.radius, args.concentration)
+
+    fig.canvas.mpl_connect('button_press_event', onclick)
+    shown = None
+    while plt.fignum_exists(fig.number):
+        frame = latest[0]
+        if frame is not None and frame is not shown:
+            header, levels = shown = frame
+            im.set_data(levels.copy())
+            title.set_text(f't = {header["t"]:.2f}, {client.bytes / 1024:.0f} KB received')
+        plt.pause(0.02)
+    client.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream a simulation to remote viewers, or view one.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('serve', help='run a scenario headlessly and stream its frames')
+    p.add_argument('method', choices=sorted(STEPPERS))
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8765)
+    p.add_argument('--fps', type=float, default=15)
+    p.add_argument('--tile', type=int, default=32)
+    p.add_argument('--max-pixels', type=int, default=1024)
+    p.add_argument('--steps-per-frame', type=int, default=1, help='steps between command checks')
+    p.set_defaults(run=serve)
+    p = commands.add_parser('view', help='show the frames of a running server')
+    p.add_argument('address', help='HOST:PORT')
+    p.add_argument('--radius', type=float, default=5)
+    p.add_argument('--concentration', type=float, default=10)
+    p.set_defaults(run=view)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1103 @@
+import argparse
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+from scipy.fft import rfft2, irfft2
+from scipy.linalg import get_lapack_funcs
+
+import sources
+from output import SnapshotWriter
+from probes import ProbeRecorder
+from convergence import SteadyState, run_until_steady
+
+log = logging.getLogger(__name__)
+
+
+# Simulation state shared between a stepper and whatever renders it.
+# The field is indexed as field[i, j] with axis 0 spaced by dx and axis 1 by dy.
+class State:
+    def __init__(self, field, dx, dy, D, dt):
+        self._field = field
+        self._materialize = None
+        self.dx, self.dy = dx, dy
+        self.D = D
+        self.dt = dt
+        self.t = 0.0       # Simulated time
+        self.step = 0      # Number of steps taken
+        self.u_hat = None  # Fourier coefficients (spectral method only)
+
+    # Real-space field; recomputed on first access after a stepper deferred it
+    @property
+    def field(self):
+        if self._field is None:
+            self._field = self._materialize()
+        return self._field
+
+    @field.setter
+    def field(self, value):
+        self._field = value
+
+    # Mark the field stale; materialize() rebuilds it when it is next read
+    def defer_field(self, materialize):
+        self._field = None
+        self._materialize = materialize
+
+    @property
+    def shape(self):
+        return self.field.shape
+
+
+# A callback run by Stepper.advance() every `every_steps` steps or every
+# `every_t` of simulated time, e.g. a snapshot writer
+class _Observer:
+    def __init__(self, callback, state, every_steps=None, every_t=None):
+        if (every_steps is None) == (every_t is None):
+            raise ValueError('give exactly one of every_steps and every_t')
+        self.callback = callback
+        self.every_steps, self.every_t = every_steps, every_t
+        self.next_step = state.step + (every_steps or 0)
+        self.next_t = state.t + (every_t or 0)
+
+    # Steps left until the callback is due (at least 1)
+    def steps_to_due(self, state):
+        if self.every_steps is not None:
+            return max(self.next_step - state.step, 1)
+        return max(int(np.ceil((self.next_t - state.t) / state.dt - 1e-9)), 1)
+
+    def notify(self, state):
+        if self.every_steps is not None:
+            if state.step < self.next_step:
+                return
+            # Skip ahead after a jump of state.step (e.g. an adopted preview)
+            while self.next_step <= state.step:
+                self.next_step += self.every_steps
+        else:
+            if state.t < self.next_t - 1e-9 * state.dt:
+                return
+            while self.next_t <= state.t + 1e-9 * state.dt:
+                self.next_t += self.every_t
+        self.callback(state)
+
+
+# Common interface of the headless steppers. Subclasses implement _step(),
+# which advances state.field by one time step of size state.dt.
+class Stepper:
+    name = None
+
+    def __init__(self, state):
+        self.state = state
+        self._observers = []
+        self.pending = np.zeros(0, sources.EVENT_DTYPE)  # Scheduled sources, sorted by t
+        self._until = None  # Target time of a running advance_to()
+
+    def _step(self):
+        raise NotImplementedError
+
+    # Advance the solution by n_steps time steps, stopping at every step where
+    # an attached observer is due. Steppers with a variable dt may end a
+    # chunk early, on the time returned by _next_stop().
+    def advance(self, n_steps=1):
+        s = self.state
+        while n_steps > 0:
+            chunk = n_steps
+            for observer in self._observers:
+                chunk = min(chunk, observer.steps_to_due(s))
+            if len(self.pending):
+                chunk = min(chunk, max(int(np.ceil((self.pending['t'][0] - s.t) / s.dt - 1e-9)), 1))
+            step = s.step
+            self._advance(chunk)
+            n_steps -= s.step - step
+            self._apply_due_sources()
+            for observer in self._observers:
+                observer.notify(s)
+            if self._until is not None and s.t >= self._until - 1e-9 * s.dt:
+                break
+        return s
+
+    # Advance by n_steps without observers; steppers that can jump several
+    # steps at once override this
+    def _advance(self, n_steps):
+        state = self.state
+        for _ in range(n_steps):
+            self._step()
+            state.t += state.dt
+            state.step += 1
+
+    # Call callback(state) every every_steps steps or every every_t of
+    # simulated time while advancing; returns a handle for detach()
+    def attach(self, callback, every_steps=None, every_t=None):
+        observer = _Observer(callback, self.state, every_steps, every_t)
+        self._observers.append(observer)
+        return observer
+
+    def detach(self, observer):
+        self._observers.remove(observer)
+
+    # Schedule source events (EVENT_DTYPE, physical units) for their time
+    # events['t']; events that are already due are applied right away
+    def schedule(self, events):
+        events = np.atleast_1d(events).astype(sources.EVENT_DTYPE)
+        pending = np.concatenate([self.pending, events])
+        self.pending = pending[np.argsort(pending['t'], kind='stable')]
+        self._apply_due_sources()
+
+    def _apply_due_sources(self):
+        s = self.state
+        if len(self.pending) and self.pending['t'][0] <= s.t + 1e-9 * s.dt:
+            due = np.searchsorted(self.pending['t'], s.t + 1e-9 * s.dt, side='right')
+            events, self.pending = self.pending[:due], self.pending[due:]
+            self.apply_events(events)
+
+    # Earliest simulated time after state.t at which advancing must stop: an
+    # every_t observer or scheduled source falling due, or the advance_to()
+    # target (None if there is none)
+    def _next_stop(self):
+        s = self.state
+        times = [observer.next_t for observer in self._observers if observer.every_t is not None]
+        if len(self.pending):
+            times.append(self.pending['t'][0])
+        if self._until is not None:
+            times.append(self._until)
+        return min((t for t in times if t > s.t + 1e-9 * s.dt), default=None)
+
+    # Advance the solution until the simulated time reaches t (with a fixed
+    # dt, the first step boundary at or after t)
+    def advance_to(self, t):
+        s = self.state
+        self._until = t
+        try:
+            while s.t < t - 1e-9 * s.dt:
+                self.advance(max(int(np.ceil((t - s.t) / s.dt - 1e-9)), 1))
+        finally:
+            self._until = None
+        return s
+
+    # Call after state.field has been modified in place (e.g. a new source)
+    def refresh(self):
+        pass
+
+    # Constructor options needed to rebuild an equivalent stepper (checkpoints)
+    def options(self):
+        return {}
+
+    # Field-sized work arrays a steady-state step keeps alive besides the field
+    work_arrays = 0
+
+    # Projected working set of a step in bytes
+    def projected_bytes(self):
+        return self.state.field.nbytes * (1 + self.work_arrays)
+
+    # Bytes of the arrays currently held by the state and the stepper
+    def allocated_bytes(self):
+        held = {}
+        for value in [self.state._field, self.state.u_hat, *vars(self).values()]:
+            if isinstance(value, np.ndarray):
+                held[id(value)] = value.nbytes
+        return sum(held.values())
+
+    # One-line summary of the memory budget, printed before a run starts
+    def memory_report(self):
+        s = self.state
+        shape = 'x'.join(map(str, s.field.shape))
+        return (f'{self.name}: {shape} {s.field.dtype} grid, projected working set '
+                f'{self.projected_bytes() / 1024**2:.1f} MB, allocated {self.allocated_bytes() / 1024**2:.1f} MB')
+
+    # Set all concentrations to zero
+    def reset(self):
+        self.state.field.fill(0)
+        self.refresh()
+
+    # Stamp disk-shaped sources centred on grid cells (i, j), radius in cells;
+    # see sources.stamp() for the modes and batching of per-event arrays
+    def add_sources(self, i, j, radius, concentration, mode='set'):
+        sources.stamp(self.state.field, i, j, radius, concentration, mode)
+        self.refresh()
+
+    # Apply source events in physical units, e.g. from sources.load_events()
+    def apply_events(self, events):
+        s = self.state
+        i, j = sources.to_grid(events, s.dx, s.dy)
+        sources.stamp(s.field, i, j, events['radius'], events['concentration'],
+                      events['mode'], s.dx, s.dy)
+        self.refresh()
+
+
+# Return buf if it can hold an array of the given shape/dtype, else a new one
+def _reuse(buf, shape, dtype):
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        return np.empty(shape, dtype)
+    return buf
+
+
+# Runs row-strip kernels of the buffered steppers on a thread pool. NumPy
+# releases the GIL inside ufunc loops, so strips of a large grid are stepped
+# in parallel; each strip reads its neighbours' rows directly (the halo) and
+# writes only its own rows, so the result is bit-identical to one strip.
+class _StripRunner:
+    def __init__(self, workers=1):
+        if workers < 1:
+            raise ValueError(f'workers must be at least 1, got {workers}')
+        self.workers = workers
+        self._pool = None
+
+    # Split rows [start, stop) into one strip per worker
+    def strips(self, start, stop):
+        n = min(self.workers, max(stop - start, 1))
+        bounds = np.linspace(start, stop, n + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    # Call kernel(a, b) for every strip and wait for all of them
+    def run(self, kernel, start, stop):
+        strips = self.strips(start, stop)
+        if len(strips) == 1:
+            kernel(*strips[0])
+            return
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        for future in [self._pool.submit(kernel, a, b) for a, b in strips]:
+            future.result()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+# A scalar parameter as is, or a per-member array of an ensemble
+# (field of shape (batch, nx, ny)) shaped to broadcast against the field
+def _per_member(value, dtype=None):
+    if np.ndim(value) == 0:
+        return value
+    return np.asarray(value, dtype)[:, None, None]
+
+
+# Tracks the parts of a field that hold pollutant, for the active-region mode
+# of the explicit steppers. The grid is split into tile x tile tiles; a tile
+# is hot once any |value| in it exceeds tol. The hot tiles plus a one-tile
+# halo are covered by disjoint rectangles (rects, in cells) and only those
+# are stepped; everything else keeps its values. Tiles only join (the halo
+# grows with the plume and merges neighbouring rectangles) until rescan(),
+# which the steppers call whenever the field is modified from outside. Once
+# the region comes within margin cells of the edges or covers more than half
+# of the grid it is marked full and the steppers do full steps again.
+class _ActiveRegion:
+    def __init__(self, tol, tile=32, margin=0):
+        if tol <= 0 or tile < 1:
+            raise ValueError(f'need active_tol > 0 and tile >= 1, got {tol} and {tile}')
+        self.tol, self.tile, self.margin = tol, tile, margin
+        self.rescan()
+
+    def rescan(self):
+        self.tiles = None  # hot tile mask, None until scan()
+        self.rects = []
+        self.full = False
+
+    # Per-tile maxima of |u| over cells [rows, cols) (all members of an ensemble)
+    def _tile_max(self, u, rows, cols):
+        block = np.abs(u[..., rows[0]:rows[1], cols[0]:cols[1]])
+        if block.ndim > 2:
+            block = block.max(axis=tuple(range(block.ndim - 2)))
+        r = np.arange(0, block.shape[0], self.tile)
+        c = np.arange(0, block.shape[1], self.tile)
+        return np.maximum.reduceat(np.maximum.reduceat(block, r, axis=0), c, axis=1)
+
+    def scan(self, u):
+        self.tiles = self._tile_max(u, (0, u.shape[-2]), (0, u.shape[-1])) > self.tol
+        self._cover(u.shape[-2:])
+
+    # Mark tiles inside the stepped rectangles that became hot
+    def update(self, u):
+        if self.full:
+            return
+        T = self.tile
+        grown = False
+        for a, b, c, d in self._tile_rects:
+            hot = self._tile_max(u, (a * T, b * T), (c * T, d * T)) > self.tol
+            tiles = self.tiles[a:b, c:d]
+            if (hot & ~tiles).any():
+                tiles |= hot
+                grown = True
+        if grown:
+            self._cover(u.shape[-2:])
+
+    def _cover(self, shape):
+        nx, ny = shape
+        T = self.tile
+        region = ndimage.binary_dilation(self.tiles, np.ones((3, 3), bool))
+        labels, _ = ndimage.label(region, np.ones((3, 3), bool))
+        boxes = [(r.start, r.stop, c.start, c.stop) for r, c in ndimage.find_objects(labels)]
+        self._tile_rects = _merge_boxes(boxes)
+        self.rects = [(a * T, min(b * T, nx), c * T, min(d * T, ny))
+                      for a, b, c, d in self._tile_rects]
+        m = self.margin
+        area = sum((b - a) * (d - c) for a, b, c, d in self.rects)
+        self.full = area > nx * ny / 2 or any(
+            a < m or b > nx - m or c < m or d > ny - m for a, b, c, d in self.rects)
+
+
+# Merge overlapping boxes (a, b, c, d) = rows [a, b) x cols [c, d) into their
+# union until no two overlap
+def _merge_boxes(boxes):
+    boxes = list(boxes)
+    k = 0
+    while k < len(boxes):
+        a, b, c, d = boxes[k]
+        for m in range(k + 1, len(boxes)):
+            e, f, g, h = boxes[m]
+            if a < f and e < b and c < h and g < d:
+                boxes[k] = (min(a, e), max(b, f), min(c, g), max(d, h))
+                del boxes[m]
+                break
+        else:
+            k += 1
+            continue
+        k = 0
+    return boxes
+
+
+# Adaptive time-step control of the explicit steppers (adaptive=tol). Before
+# every step dt is capped at safety * stepper.stable_dt(), so a larger D can
+# never make the run unstable. Every check_every steps the step is taken by
+# step doubling: one step of dt and two of dt/2 from the same field, whose
+# largest difference estimates the local error. The two half steps are kept
+# if it is below tol (otherwise dt shrinks and the step is retried), and the
+# next dt is dt * safety * sqrt(tol / error) (Forward Euler's local error is
+# O(dt^2)), so dt grows as the plume smooths out. dt only grows by more than
+# 10% at a time, and every change is logged and kept in changes as
+# (t, old dt, new dt, reason). A step that would pass t_stop (an observer or
+# source due time, see Stepper._next_stop()) is shortened to end exactly on
+# it and the chunk ends there; such a landing step is never longer than the
+# accepted dt, so it skips the error check and leaves state.dt unchanged.
+class _StepController:
+    def __init__(self, tol, check_every=10, safety=0.9):
+        if tol <= 0 or check_every < 1:
+            raise ValueError(f'need adaptive tol > 0 and check_every >= 1, got {tol} and {check_every}')
+        self.tol, self.check_every, self.safety = tol, check_every, safety
+        self.changes = []
+        self.rejected = 0
+        self._since_check = check_every  # check on the first step
+
+    def _set_dt(self, state, dt, reason):
+        self.changes.append((state.t, state.dt, dt, reason))
+        log.info('t=%.6g: dt %.4g -> %.4g (%s)', state.t, state.dt, dt, reason)
+        state.dt = dt
+
+    def advance(self, stepper, n_steps, t_stop=None):
+        s = stepper.state
+        for _ in range(n_steps):
+            limit = self.safety * stepper.stable_dt()
+            if s.dt > limit:
+                self._set_dt(s, limit, 'stability limit')
+            if t_stop is not None and s.t + s.dt >= t_stop - 1e-9 * s.dt:
+                dt = s.dt
+                s.dt = t_stop - s.t
+                stepper._step()
+                s.t, s.dt = t_stop, dt
+                s.step += 1
+                self._since_check += 1
+                return
+            proposed = None
+            if self._since_check >= self.check_every:
+                proposed = min(self._doubling_step(stepper), limit)
+                self._since_check = 0
+            else:
+                stepper._step()
+            s.t += s.dt
+            s.step += 1
+            self._since_check += 1
+            if proposed is not None and (proposed < s.dt or proposed > 1.1 * s.dt):
+                self._set_dt(s, proposed, 'error control')
+
+    # Take one step of state.dt by step doubling, retrying with smaller steps
+    # while the error is too large; returns the proposed next dt
+    def _doubling_step(self, stepper):
+        s = stepper.state
+        while True:
+            dt = s.dt
+            start = s.field.copy()
+            stepper._step()
+            full = s.field.copy()
+            s.field = start.copy()
+            s.dt = dt / 2
+            stepper._step()
+            stepper._step()
+            s.dt = dt
+            error = float(np.max(np.abs(s.field - full)))
+            scale = self.safety * np.sqrt(self.tol / error) if error > 0 else 2.0
+            scale = min(max(scale, 0.2), 2.0)
+            if error <= self.tol:
+                return dt * scale
+            self.rejected += 1
+            s.field = start
+            self._set_dt(s, dt * scale, f'error {error:.2g} > {self.tol:g}, step retried')
+
+
+# Explicit 5-point finite-difference stencil, edges held fixed. Like all
+# steppers it also accepts an ensemble field of shape (batch, nx, ny) with a
+# scalar or per-member D.
+# With buffered=True (default) the step ping-pongs between two preallocated
+# grids and evaluates the stencil with out= ufuncs into preallocated scratch,
+# so a steady-state step allocates no grid-sized temporaries (only NumPy's
+# small fixed-size iterator buffers). Results are bit-identical to the
+# buffered=False reference path. workers > 1 steps row strips of the buffered
+# path on a thread pool, again bit-identically.
+# active_tol enables the active-region mode (buffered path only): only tiles
+# holding concentrations above active_tol plus a one-tile halo are stepped
+# (serially), with the same arithmetic as a full step. The rest of the lake
+# keeps its values, so results differ from full steps by at most about
+# active_tol.
+# adaptive=tol lets state.dt adapt within the stability limit (see
+# _StepController); stable_dt() gives that limit.
+class FiniteDifferenceStepper(Stepper):
+    name = 'fd'
+
+    def __init__(self, state, buffered=True, workers=1, active_tol=None, tile=32, adaptive=None):
+        super().__init__(state)
+        if active_tol is not None and not buffered:
+            raise ValueError('the active-region mode needs buffered=True')
+        if active_tol is not None and adaptive is not None:
+            raise ValueError('the active-region and adaptive modes cannot be combined')
+        self.buffered = buffered
+        # Back buffer and scratch, or C_new and the temporaries of the slice expression
+        self.work_arrays = 2 if buffered else 5
+        self._runner = _StripRunner(workers)
+        self._back = None
+        self._scratch = None
+        self.active_tol, self.tile = active_tol, tile
+        self._region = _ActiveRegion(active_tol, tile) if active_tol is not None else None
+        self.adaptive = adaptive
+        self.control = _StepController(adaptive) if adaptive is not None else None
+
+    def options(self):
+        return {'buffered': self.buffered, 'active_tol': self.active_tol, 'tile': self.tile,
+                'adaptive': self.adaptive}
+
+    def refresh(self):
+        if self._region is not None:
+            self._region.rescan()
+
+    # Largest stable dt of the explicit stencil: D dt (1/dx^2 + 1/dy^2) <= 1/2
+    def stable_dt(self):
+        s = self.state
+        return 1 / (2 * np.max(s.D) * (1 / s.dx**2 + 1 / s.dy**2))
+
+    def _advance(self, n_steps):
+        if self.control is None:
+            super()._advance(n_steps)
+        else:
+            self.control.advance(self, n_steps, self._next_stop())
+
+    # Shut down the worker threads (if any)
+    def close(self):
+        self._runner.close()
+
+    def _step(self):
+        if self.buffered:
+            self._step_buffered()
+        else:
+            self._step_reference()
+
+    def _step_buffered(self):
+        s = self.state
+        C = s.field
+        back = self._back
+        region = self._region
+        if back is None or back is C or back.shape != C.shape or back.dtype != C.dtype:
+            back = np.empty_like(C)
+            if region is not None:
+                region.rescan()
+        if region is not None and region.tiles is None:
+            # Cells outside the region are never written, so both buffers
+            # must agree on them
+            region.scan(C)
+            np.copyto(back, C)
+        interior = C.shape[:-2] + (C.shape[-2] - 2, C.shape[-1] - 2)
+        scratch = self._scratch = _reuse(self._scratch, interior, C.dtype)
+
+        # Edges are held fixed, carry them over to the back buffer
+        back[..., 0, :] = C[..., 0, :]
+        back[..., -1, :] = C[..., -1, :]
+        back[..., :, 0] = C[..., :, 0]
+        back[..., :, -1] = C[..., :, -1]
+
+        coef = _per_member(s.D, C.dtype) * s.dt
+        dx2, dy2 = s.dx**2, s.dy**2
+        nx, ny = C.shape[-2:]
+
+        # Update interior rows [a, b) (columns [c, d)), reading one cell
+        # around them as halo
+        def rows(a, b, c=1, d=ny - 1):
+            mid = C[..., a:b, c:d]
+            out = back[..., a:b, c:d]
+            tmp = scratch[..., a - 1:b - 1, c - 1:d - 1]
+            np.multiply(mid, 2, out=tmp)
+            np.subtract(C[..., a + 1:b + 1, c:d], tmp, out=out)
+            np.add(out, C[..., a - 1:b - 1, c:d], out=out)
+            np.divide(out, dx2, out=out)
+            np.subtract(C[..., a:b, c + 1:d + 1], tmp, out=tmp)
+            np.add(tmp, C[..., a:b, c - 1:d - 1], out=tmp)
+            np.divide(tmp, dy2, out=tmp)
+            np.add(out, tmp, out=out)
+            np.multiply(out, coef, out=out)
+            np.add(mid, out, out=out)
+
+        if region is None or region.full:
+            self._runner.run(rows, 1, nx - 1)
+        else:
+            for a, b, c, d in region.rects:
+                a, b, c, d = max(a, 1), min(b, nx - 1), max(c, 1), min(d, ny - 1)
+                if a < b and c < d:
+                    rows(a, b, c, d)
+
+        # Swap the front and back buffers
+        self._back = C
+        s.field = back
+        if region is not None:
+            region.update(back)
+
+    def _step_reference(self):
+        s = self.state
+        C, D, dt, dx, dy = s.field, _per_member(s.D, s.field.dtype), s.dt, s.dx, s.dy
+        nx, ny = C.shape[-2:]
+        C_new = C.copy()
+        C_new[..., 1:nx-1, 1:ny-1] = C[..., 1:nx-1, 1:ny-1] + D * dt * (
+            (C[..., 2:nx, 1:ny-1] - 2 * C[..., 1:nx-1, 1:ny-1] + C[..., 0:nx-2, 1:ny-1]) / dx**2 +
+            (C[..., 1:nx-1, 2:ny] - 2 * C[..., 1:nx-1, 1:ny-1] + C[..., 1:nx-1, 0:ny-2]) / dy**2
+        )
+        s.field = C_new
+
+
+# Forward Euler flux update with no-flux (edge copy) boundaries.
+# With buffered=True (default) the periodic shifts of np.roll are replaced by
+# slice arithmetic into three preallocated scratch grids, so a steady-state
+# step allocates no grid-sized temporaries. Results are bit-identical to the
+# buffered=False reference path. workers > 1 steps row strips of the buffered
+# path on a thread pool, again bit-identically.
+# active_tol enables the active-region mode (see FiniteDifferenceStepper);
+# while the region stays clear of the edges (where the periodic differences
+# wrap and the no-flux copies apply) only its rectangles are updated.
+# adaptive=tol lets state.dt adapt within the stability limit of this
+# stencil (see _StepController and stable_dt()).
+class ForwardEulerStepper(Stepper):
+    name = 'euler'
+
+    def __init__(self, state, buffered=True, workers=1, active_tol=None, tile=32, adaptive=None):
+        super().__init__(state)
+        if active_tol is not None and adaptive is not None:
+            raise ValueError('the active-region and adaptive modes cannot be combined')
+        self.buffered = buffered
+        # Flux and update scratch, or the rolled copies and temporaries
+        self.work_arrays = 3 if buffered else 6
+        self._runner = _StripRunner(workers)
+        self._flux_x = self._flux_y = self._du = None
+        self.active_tol, self.tile = active_tol, tile
+        self._region = _ActiveRegion(active_tol, tile, margin=2) if active_tol is not None else None
+        self.adaptive = adaptive
+        self.control = _StepController(adaptive) if adaptive is not None else None
+
+    def options(self):
+        return {'buffered': self.buffered, 'active_tol': self.active_tol, 'tile': self.tile,
+                'adaptive': self.adaptive}
+
+    # Largest stable dt of this stencil (von Neumann analysis, see _euler_stable_dt)
+    def stable_dt(self):
+        s = self.state
+        return _euler_stable_dt(s.dx, s.dy) / np.max(s.D)
+
+    def _advance(self, n_steps):
+        if self.control is None:
+            super()._advance(n_steps)
+        else:
+            self.control.advance(self, n_steps, self._next_stop())
+
+    # Shut down the worker threads (if any)
+    def close(self):
+        self._runner.close()
+
+    def refresh(self):
+        if self._region is not None:
+            self._region.rescan()
+
+    def _step(self):
+        region = self._region
+        if region is not None and region.tiles is None:
+            region.scan(self.state.field)
+        if region is not None and not region.full:
+            self._step_regions(region.rects)
+            region.update(self.state.field)
+            return
+        if self.buffered:
+            self._step_buffered()
+        else:
+            self._step_reference()
+        self._apply_boundaries()
+
+    # Active-region step: the update of every rectangle is computed from the
+    # field before any is written, with the arithmetic of the buffered path
+    def _step_regions(self, rects):
+        s = self.state
+        u, D, dt = s.field, _per_member(s.D, s.field.dtype), s.dt
+        updates = []
+        for a, b, c, d in rects:
+            fx = (u[..., a:b + 1, c:d] - u[..., a - 2:b - 1, c:d]) * D / (2 * s.dx)
+            fy = (u[..., a:b, c:d + 1] - u[..., a:b, c - 2:d - 1]) * D / (2 * s.dy)
+            du = fx[..., 1:, :] - fx[..., :-1, :]
+            du += fy[..., 1:]
+            du -= fy[..., :-1]
+            du *= dt
+            updates.append(du)
+        for (a, b, c, d), du in zip(rects, updates):
+            u[..., a:b, c:d] += du
+
+    def _step_buffered(self):
+        s = self.state
+        u, D, dt = s.field, _per_member(s.D, s.field.dtype), s.dt
+        fx = self._flux_x = _reuse(self._flux_x, u.shape, u.dtype)
+        fy = self._flux_y = _reuse(self._flux_y, u.shape, u.dtype)
+        du = self._du = _reuse(self._du, u.shape, u.dtype)
+
+        n = u.shape[-2]
+
+        # Compute fluxes (diffusion) of rows [a, b), periodic central differences
+        def fluxes(a, b):
+            lo, hi = max(a, 1), min(b, n - 1)
+            np.subtract(u[..., lo + 1:hi + 1, :], u[..., lo - 1:hi - 1, :], out=fx[..., lo:hi, :])
+            if a == 0:
+                np.subtract(u[..., 1, :], u[..., -1, :], out=fx[..., 0, :])
+            if b == n:
+                np.subtract(u[..., 0, :], u[..., -2, :], out=fx[..., -1, :])
+            np.multiply(fx[..., a:b, :], D, out=fx[..., a:b, :])
+            np.divide(fx[..., a:b, :], 2 * s.dx, out=fx[..., a:b, :])
+            v, out = u[..., a:b, :], fy[..., a:b, :]
+            np.subtract(v[..., 2:], v[..., :-2], out=out[..., 1:-1])
+            np.subtract(v[..., 1], v[..., -1], out=out[..., 0])
+            np.subtract(v[..., 0], v[..., -2], out=out[..., -1])
+            np.multiply(out, D, out=out)
+            np.divide(out, 2 * s.dy, out=out)
+
+        # Flux divergence of rows [a, b), then the Forward Euler update
+        def update(a, b):
+            lo = max(a, 1)
+            np.subtract(fx[..., lo:b, :], fx[..., lo - 1:b - 1, :], out=du[..., lo:b, :])
+            if a == 0:
+                np.subtract(fx[..., 0, :], fx[..., -1, :], out=du[..., 0, :])
+            out, g = du[..., a:b, :], fy[..., a:b, :]
+            np.add(out, g, out=out)
+            np.subtract(out[..., 1:], g[..., :-1], out=out[..., 1:])
+            np.subtract(out[..., 0], g[..., -1], out=out[..., 0])
+            np.multiply(out, dt, out=out)
+            np.add(u[..., a:b, :], out, out=u[..., a:b, :])
+
+        # All fluxes must be ready before any row of u is overwritten
+        self._runner.run(fluxes, 0, n)
+        self._runner.run(update, 0, n)
+
+    def _step_reference(self):
+        s = self.state
+        u, D, dt, dx, dy = s.field, _per_member(s.D, s.field.dtype), s.dt, s.dx, s.dy
+
+        # Compute fluxes (diffusion)
+        flux_x = D * (np.roll(u, -1, axis=-2) - np.roll(u, 1, axis=-2)) / (2 * dx)
+        flux_y = D * (np.roll(u, -1, axis=-1) - np.roll(u, 1, axis=-1)) / (2 * dy)
+
+        # Update concentration using Forward Euler method
+        u += dt * (flux_x - np.roll(flux_x, 1, axis=-2) + flux_y - np.roll(flux_y, 1, axis=-1))
+
+    # Boundary conditions (no-flux)
+    def _apply_boundaries(self):
+        u = self.state.field
+        u[..., 0, :] = u[..., 1, :]
+        u[..., -1, :] = u[..., -2, :]
+        u[..., :, 0] = u[..., :, 1]
+        u[..., :, -1] = u[..., :, -2]
+
+
+# Stability limit of the Forward Euler flux stencil for D = 1. Per axis the
+# update is u_i += dt D / (2h) (u[i+1] - u[i-1] - u[i] + u[i-2]), whose
+# symbol s(k) = e^{ik} - 1 - e^{-ik} + e^{-2ik} has Re s <= 0; a mode stays
+# bounded while |1 + dt z| <= 1, i.e. dt <= -2 Re z / |z|^2, where z is the
+# sum of the per-axis symbols. The minimum is taken over a grid of modes;
+# the no-flux copies damp some of these modes, so the bound is conservative.
+@functools.lru_cache(maxsize=8)
+def _euler_stable_dt(dx, dy, n=256):
+    k = 2 * np.pi * np.arange(n) / n
+    symbol = np.exp(1j * k) - 1 - np.exp(-1j * k) + np.exp(-2j * k)
+    z = symbol[:, None] / (2 * dx) + symbol[None, :] / (2 * dy)
+    nonzero = np.abs(z) > 1e-12
+    return float(np.min(-2 * z.real[nonzero] / np.abs(z[nonzero])**2))
+
+
+# LU factors of the tridiagonal 1-D operator (I - coef * d2/dx2) on n points
+# with spacing h. Factorizations are cached, so repeated steps (and steps
+# after new sources are added) only pay for the O(n) back substitution.
+@functools.lru_cache(maxsize=32)
+def _tridiagonal_factors(n, h, coef, boundary, dtype):
+    a = coef / h**2
+    d = np.full(n, 1 + 2 * a, dtype)
+    dl = np.full(n - 1, -a, dtype)
+    du = np.full(n - 1, -a, dtype)
+    if boundary == 'fixed':
+        # Edge values are held constant (identity rows)
+        d[0] = d[-1] = 1
+        du[0] = dl[-1] = 0
+    else:
+        # No-flux edges via a mirrored ghost point
+        du[0] = dl[-1] = -2 * a
+    gttrf, gttrs = get_lapack_funcs(('gttrf', 'gttrs'), dtype=np.dtype(dtype))
+    dl, d, du, du2, ipiv, info = gttrf(dl, d, du)
+    if info != 0:
+        raise np.linalg.LinAlgError(f'tridiagonal factorization failed (info={info})')
+    return gttrs, (dl, d, du, du2, ipiv)
+
+
+# Alternating-direction implicit (ADI) stepper for the standard 5-point
+# Laplacian, unconditionally stable so dt is not limited by D*dt/dx**2.
+# Each step does a theta-weighted implicit sweep along axis 0 then axis 1:
+#   (I - theta*dt*D*Lx) u* = (I + (1-theta)*dt*D*Ly) u
+#   (I - theta*dt*D*Ly) u' = (I + (1-theta)*dt*D*Lx) u*
+# theta=0.5 is Peaceman-Rachford (second order, Crank-Nicolson like) and
+# theta=1 is the L-stable backward Euler splitting, which damps the ringing
+# of sharp sources when dt is very large. boundary is 'fixed' (edges held,
+# as in the FD script) or 'no-flux' (as in the Forward Euler script).
+class ADIStepper(Stepper):
+    name = 'adi'
+    work_arrays = 4  # Right-hand sides, Laplacian and solution copies
+
+    def __init__(self, state, theta=0.5, boundary='fixed'):
+        if boundary not in ('fixed', 'no-flux'):
+            raise ValueError(f"boundary must be 'fixed' or 'no-flux', got {boundary!r}")
+        super().__init__(state)
+        self.theta = theta
+        self.boundary = boundary
+
+    def options(self):
+        return {'theta': self.theta, 'boundary': self.boundary}
+
+    # u + coef * d2u/dh2 along the last axis of u
+    def _explicit(self, u, coef, h):
+        if coef == 0:
+            return u.copy()
+        lap = np.empty_like(u)
+        np.subtract(u[..., 2:] + u[..., :-2], 2 * u[..., 1:-1], out=lap[..., 1:-1])
+        if self.boundary == 'fixed':
+            lap[..., 0] = lap[..., -1] = 0
+        else:
+            lap[..., 0] = 2 * (u[..., 1] - u[..., 0])
+            lap[..., -1] = 2 * (u[..., -2] - u[..., -1])
+        lap *= coef / h**2
+        lap += u
+        return lap
+
+    # Solve (I - coef * d2/dh2) x = b along axis 0 of b
+    def _implicit(self, b, coef, h):
+        gttrs, factors = _tridiagonal_factors(b.shape[0], h, coef, self.boundary, b.dtype.char)
+        x, info = gttrs(*factors, b)
+        return x
+
+    def _hold_edges(self, u, edges):
+        if edges is not None:
+            u[0, :], u[-1, :], u[:, 0], u[:, -1] = edges
+
+    def _step(self):
+        s = self.state
+        if s.field.ndim == 2:
+            s.field = self._step_member(s.field, s.D)
+        else:
+            # Ensemble members may have different D and so different factors
+            D = np.broadcast_to(s.D, s.field.shape[:1])
+            s.field = np.stack([self._step_member(u, d) for u, d in zip(s.field, D)])
+
+    def _step_member(self, u, D):
+        s = self.state
+        implicit = self.theta * D * s.dt
+        explicit = (1 - self.theta) * D * s.dt
+        edges = None
+        if self.boundary == 'fixed':
+            edges = (u[0, :].copy(), u[-1, :].copy(), u[:, 0].copy(), u[:, -1].copy())
+
+        # Implicit along axis 0, explicit along axis 1
+        rhs = self._explicit(u, explicit, s.dy)
+        self._hold_edges(rhs, edges)
+        u = self._implicit(rhs, implicit, s.dx)
+
+        # Implicit along axis 1, explicit along axis 0 (via transposed views)
+        rhs = self._explicit(u.T, explicit, s.dx).T
+        self._hold_edges(rhs, edges)
+        u = self._implicit(rhs.T, implicit, s.dy).T
+
+        self._hold_edges(u, edges)
+        return np.ascontiguousarray(u)
+
+
+# Squared wavenumbers of the real FFT of an array of the given shape, as a
+# column kx**2 and a row ky**2 that broadcast to |k|^2 (no dense meshgrids)
+@functools.lru_cache(maxsize=8)
+def _wavenumbers2(shape, dx, dy, dtype):
+    kx = np.fft.fftfreq(shape[0], dx) * 2 * np.pi
+    ky = np.fft.rfftfreq(shape[1], dy) * 2 * np.pi
+    return (kx**2).astype(dtype)[:, None], (ky**2).astype(dtype)[None, :]
+
+
+# Heat-equation propagator exp(-D |k|^2 t) = exp(-D kx^2 t) exp(-D ky^2 t) as
+# its two separable factors, a column and a row (per member for a tuple D),
+# cached by grid, D, t and dtype. Applying them one after the other never
+# forms the dense (nx, ny//2+1) array, so the cache holds O(nx + ny) values.
+@functools.lru_cache(maxsize=16)
+def _propagator(shape, dx, dy, D, t, dtype):
+    kx2, ky2 = _wavenumbers2(shape, dx, dy, dtype)
+    D = _per_member(D, dtype)
+    return np.exp(-D * kx2 * t), np.exp(-D * ky2 * t)
+
+
+# D in a hashable form for the propagator cache
+def _cache_key(D):
+    return float(D) if np.ndim(D) == 0 else tuple(np.ravel(D).tolist())
+
+
+# Fourier spectral solution on a periodic domain. The heat equation is
+# diagonal in Fourier space, so the stepper only multiplies the real-FFT
+# coefficients state.u_hat by the cached factors of the propagator;
+# advance(n) is a single multiply for any n (one per observer stop). The
+# real-space field is transformed back lazily, only when state.field is read.
+class SpectralStepper(Stepper):
+    name = 'spectral'
+
+    def __init__(self, state):
+        super().__init__(state)
+        self.shape = state.field.shape[-2:]
+        self.dtype = state.field.dtype
+        self.refresh()
+
+    def _to_real(self):
+        return irfft2(self.state.u_hat, s=self.shape)
+
+    def _evolve(self, t):
+        s = self.state
+        decay_x, decay_y = _propagator(self.shape, s.dx, s.dy, _cache_key(s.D), t, self.dtype.char)
+        s.u_hat *= decay_x
+        s.u_hat *= decay_y
+        s.defer_field(self._to_real)
+
+    def _step(self):
+        self._evolve(self.state.dt)
+
+    def _advance(self, n_steps):
+        s = self.state
+        if n_steps > 0:
+            self._evolve(n_steps * s.dt)
+            s.t += n_steps * s.dt
+            s.step += n_steps
+
+    # Real-space field at time t >= state.t, computed with one multiply and
+    # one inverse transform without changing the state
+    def state_at(self, t):
+        s = self.state
+        if t < s.t:
+            raise ValueError(f'cannot evaluate t={t} before the current time {s.t}')
+        decay_x, decay_y = _propagator.__wrapped__(self.shape, s.dx, s.dy, s.D, t - s.t, self.dtype.char)
+        u_hat = s.u_hat * decay_x
+        u_hat *= decay_y
+        return irfft2(u_hat, s=self.shape)
+
+    def refresh(self):
+        self.state.u_hat = rfft2(self.state.field)
+
+    # Field, half-spectrum coefficients and the propagator factors the cache
+    # can hold (one column and one row per member and cached t)
+    def projected_bytes(self):
+        s = self.state
+        batch = s.u_hat.shape[:-2]
+        modes = self.shape[0] * (self.shape[1] // 2 + 1)
+        field = int(np.prod(batch + self.shape)) * self.dtype.itemsize
+        u_hat = int(np.prod(batch)) * modes * s.u_hat.dtype.itemsize
+        factors = (int(np.prod(batch)) if np.ndim(s.D) else 1) * (self.shape[0] + self.shape[1] // 2 + 1)
+        propagator = _propagator.cache_info().maxsize * factors * self.dtype.itemsize
+        return field + u_hat + propagator
+
+    # Sources only touch a few small patches, so the coefficients are updated
+    # with the DFT of each patch (two small matrix products) instead of a full
+    # forward transform. Large batches fall back to stamping and refresh().
+    def add_sources(self, i, j, radius, concentration, mode='set'):
+        self._add_sources(i, j, radius, concentration, mode, 1.0, 1.0)
+
+    def apply_events(self, events):
+        s = self.state
+        i, j = sources.to_grid(events, s.dx, s.dy)
+        self._add_sources(i, j, events['radius'], events['concentration'],
+                          events['mode'], s.dx, s.dy)
+
+    def _add_sources(self, i, j, radius, concentration, mode, dx, dy):
+        s = self.state
+        nx, ny = self.shape
+        i, j, radius, concentration, mode = sources._as_events(i, j, radius, concentration, mode)
+        patches = [sources.patch(self.shape, *args, dx, dy) for args in zip(i, j, radius)]
+
+        # Rough flop counts of the patch DFTs and of a full forward transform
+        patch_cost = sum(nx * p[2].size + nx * p[2].shape[1] * (ny // 2 + 1)
+                         for p in patches if p is not None)
+        if patch_cost > 2 * nx * ny * np.log2(nx * ny):
+            sources.stamp(s.field, i, j, radius, concentration, mode, dx, dy)
+            self.refresh()
+            return
+
+        for p, value, m in zip(patches, concentration, mode):
+            if p is None:
+                continue
+            rows, cols, mask = p
+            if m == 'add':
+                delta = np.where(mask, value, 0.0)
+            else:
+                delta = np.where(mask, value - s.field[..., rows, cols], 0.0)
+            if s._field is not None:
+                s._field[..., rows, cols] += delta
+            s.u_hat += self._patch_dft(rows, cols, delta)
+
+    # rfft2 of an nx x ny array that is zero outside field[rows, cols] == delta
+    def _patch_dft(self, rows, cols, delta):
+        nx, ny = self.shape
+        wx, wy = _roots_of_unity(nx), _roots_of_unity(ny)
+        Ex = wx[np.outer(np.arange(nx), np.arange(rows.start, rows.stop)) % nx]
+        Ey = wy[np.outer(np.arange(cols.start, cols.stop), np.arange(ny // 2 + 1)) % ny]
+        return Ex @ delta @ Ey
+
+
+# exp(-2 pi i k / n) for k = 0..n-1
+@functools.lru_cache(maxsize=8)
+def _roots_of_unity(n):
+    return np.exp(-2j * np.pi * np.arange(n) / n)
+
+
+STEPPERS = {cls.name: cls for cls in (FiniteDifferenceStepper, ForwardEulerStepper, ADIStepper,
+                                      SpectralStepper)}
+
+
+# Build a stepper with the same default scenario as the corresponding script,
+# in the given precision (np.float32 halves memory and bandwidth); options are
+# passed on to the stepper class (e.g. workers=4)
+def default_stepper(method, dtype=np.float64, **options):
+    if method == 'fd':
+        Lx, Ly, dx, dy = 200, 200, 1, 1
+        state = State(np.zeros((int(Lx / dx), int(Ly / dy)), dtype), dx, dy, D=2.0, dt=0.1)
+    elif method == 'adi':
+        # The FD lake with a time step 10x beyond the explicit stability limit
+        Lx, Ly, dx, dy = 200, 200, 1, 1
+        state = State(np.zeros((int(Lx / dx), int(Ly / dy)), dtype), dx, dy, D=2.0, dt=1.0)
+    elif method == 'euler':
+        Lx, Ly, dx, dy = 100, 100, 0.5, 0.5
+        nx, ny = int(Lx / dx), int(Ly / dy)
+        # Initial concentration spike in the middle in a circular shape
+        u = sources.stamp(np.zeros((nx, ny), dtype), nx // 2, ny // 2, 5, 1.0)
+        state = State(u, dx, dy, D=10.0, dt=0.01)
+    elif method == 'spectral':
+        L, N = 100.0, 100
+        x = np.linspace(0, L, N, endpoint=False)
+        # Gaussian initial distribution, broadcast from the 1-D coordinates
+        u0 = np.exp(-((x[None, :] - L/2)**2 + (x[:, None] - L/2)**2)).astype(dtype)
+        state = State(u0, L / N, L / N, D=10, dt=0.01)
+    else:
+        raise ValueError(f'Unknown method: {method!r} (expected one of {sorted(STEPPERS)})')
+    return STEPPERS[method](state, **options)
+
+
+# Run a scenario without any display, e.g. in batch jobs on a server
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a pollutant diffusion scenario headlessly.')
+    parser.add_argument('method', choices=sorted(STEPPERS))
+    parser.add_argument('--steps', type=int, default=1000, help='number of time steps to advance')
+    parser.add_argument('--precision', choices=('float32', 'float64'), default='float64')
+    parser.add_argument('--workers', type=int,
+                        help='threads for the fd/euler kernels (default 1; results are identical)')
+    parser.add_argument('--active-tol', type=float,
+                        help='fd/euler: only step tiles with concentrations above this value')
+    parser.add_argument('--adaptive', type=float, metavar='TOL',
+                        help='fd/euler: adapt dt to this local error (within the stability limit)')
+    parser.add_argument('--output', help='save the final field to this .npy file')
+    parser.add_argument('--snapshots', help='stream decimated snapshots to this .npy stack')
+    parser.add_argument('--every', type=int, default=100, help='steps between snapshots')
+    parser.add_argument('--probes', nargs='+', metavar='X,Y',
+                        help='record the concentration at these points on every step')
+    parser.add_argument('--probe-output', default='probes.npz', help='where to save the probe series')
+    parser.add_argument('--steady-tol', type=float,
+                        help='stop early once the field changes by less than this per unit time')
+    parser.add_argument('--checkpoint', help='periodically save the solver state to this file')
+    parser.add_argument('--checkpoint-every', type=int, default=10000, help='steps between checkpoints')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from --checkpoint if it exists; --steps is the total '
+                             '(snapshots and probes then need new files)')
+    args = parser.parse_args(argv)
+    if args.adaptive is not None:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Imported here because checkpoint itself imports this module
+    import checkpoint
+
+    # Only the options that were given, so a resumed run keeps the saved ones
+    options = {}
+    if args.method in ('fd', 'euler'):
+        options = {name: getattr(args, name) for name in ('workers', 'active_tol', 'adaptive')
+                   if getattr(args, name) is not None}
+    if args.resume and args.checkpoint and os.path.exists(args.checkpoint):
+        stepper = checkpoint.load_checkpoint(args.checkpoint, **options)
+        # The stack and series only cover the resumed part of the run, so they
+        # go to new files instead of silently replacing the earlier output
+        for flag, path in (('--snapshots', args.snapshots),
+                           ('--probe-output', args.probe_output if args.probes else None)):
+            if path and os.path.exists(path):
+                parser.error(f'{flag} {path} already exists and would be overwritten; give a new '
+                             f'file for the output from step {stepper.state.step} on')
+        print(f'resumed {stepper.name} at step {stepper.state.step} from {args.checkpoint}')
+    else:
+        stepper = default_stepper(args.method, dtype=np.dtype(args.precision), **options)
+    n_steps = max(args.steps - stepper.state.step, 0)
+    print(stepper.memory_report())
+    writer = None
+    if args.snapshots:
+        writer = SnapshotWriter(args.snapshots, stepper.state.shape, n_steps // args.every + 1,
+                                dtype=stepper.state.field.dtype)
+        writer(stepper.state)
+        stepper.attach(writer, every_steps=args.every)
+    recorder = None
+    if args.probes:
+        points = [tuple(float(v) for v in p.split(',')) for p in args.probes]
+        recorder = ProbeRecorder(stepper, points, capacity=n_steps + 1)
+    if args.checkpoint:
+        stepper.attach(checkpoint.Checkpointer(stepper, args.checkpoint),
+                       every_steps=args.checkpoint_every)
+    steady = SteadyState(stepper, args.steady_tol) if args.steady_tol else None
+    start = time.perf_counter()
+    if steady is not None:
+        run_until_steady(stepper, n_steps, steady)
+        n_steps = stepper.state.step - (args.steps - n_steps)
+    else:
+        stepper.advance(n_steps)
+    state = stepper.state
+    elapsed = time.perf_counter() - start
+    if args.checkpoint:
+        checkpoint.save_checkpoint(stepper, args.checkpoint)
+    if writer is not None:
+        writer.close()
+        print(f'wrote {writer.count} snapshots to {args.snapshots} ({writer.dropped} dropped)')
+    if recorder is not None:
+        recorder.save(args.probe_output)
+        print(f'wrote {len(recorder.points)} probe series to {args.probe_output}')
+
+    print(f'{stepper.name}: {n_steps} steps to t={state.t:.4g} in {elapsed:.3f} s '
+          f'({n_steps / max(elapsed, 1e-12):.1f} steps/s), max concentration {state.field.max():.4g}')
+    if getattr(stepper, 'control', None) is not None:
+        control = stepper.control
+        print(f'adaptive dt: {len(control.changes)} changes, {control.rejected} rejected steps, '
+              f'final dt {state.dt:.4g}')
+    if steady is not None and steady.converged:
+        print(f'converged (change {steady.rate:.3g}/time unit < {args.steady_tol:g}) '
+              f'at t={steady.t_converged:.4g}, stopped early')
+    if args.output:
+        np.save(args.output, state.field)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import functools
+
+import numpy as np
+
+# Pollution source events as loaded from incident logs. x is the horizontal
+# plot coordinate (field axis 1) and y the vertical one (field axis 0), as in
+# the scripts' click handlers; radius is in the same physical units. t is the
+# simulated time of the discharge (see Stepper.schedule()).
+EVENT_DTYPE = np.dtype([('x', 'f8'), ('y', 'f8'), ('radius', 'f8'),
+                        ('concentration', 'f8'), ('mode', 'U3'), ('t', 'f8')])
+MODES = ('set', 'add')
+
+
+# Boolean disk of the cells within radius of the centre cell, for a grid with
+# spacing dx along axis 0 and dy along axis 1. Cached per radius and spacing.
+@functools.lru_cache(maxsize=64)
+def disk_mask(radius, dx=1.0, dy=1.0):
+    hi, hj = int(radius / dx), int(radius / dy)
+    a = np.arange(-hi, hi + 1)[:, None] * dx
+    b = np.arange(-hj, hj + 1)[None, :] * dy
+    mask = a**2 + b**2 <= radius**2
+    mask.setflags(write=False)
+    return mask
+
+
+# Row/column offsets of the cells of disk_mask() relative to the centre
+@functools.lru_cache(maxsize=64)
+def disk_offsets(radius, dx=1.0, dy=1.0):
+    mask = disk_mask(radius, dx, dy)
+    di, dj = np.nonzero(mask)
+    di -= mask.shape[0] // 2
+    dj -= mask.shape[1] // 2
+    di.setflags(write=False)
+    dj.setflags(write=False)
+    return di, dj
+
+
+# Clipped bounding box of a disk centred on cell (i, j) of a grid of the given
+# shape: returns (rows, cols, mask) with mask cut to the part inside the grid,
+# or None if the disk lies entirely outside
+def patch(shape, i, j, radius, dx=1.0, dy=1.0):
+    mask = disk_mask(radius, dx, dy)
+    hi, hj = mask.shape[0] // 2, mask.shape[1] // 2
+    i0, i1 = max(i - hi, 0), min(i + hi + 1, shape[0])
+    j0, j1 = max(j - hj, 0), min(j + hj + 1, shape[1])
+    if i0 >= i1 or j0 >= j1:
+        return None
+    sub = mask[i0 - (i - hi):i1 - (i - hi), j0 - (j - hj):j1 - (j - hj)]
+    return slice(i0, i1), slice(j0, j1), sub
+
+
+# Broadcast scalar or per-event source parameters to 1-D arrays
+def _as_events(i, j, radius, concentration, mode):
+    i, j, radius, concentration, mode = np.broadcast_arrays(
+        np.asarray(i, int), np.asarray(j, int), np.asarray(radius, float),
+        np.asarray(concentration, float), np.asarray(mode))
+    bad = ~np.isin(mode, MODES)
+    if bad.any():
+        raise ValueError(f'unknown source mode {mode[bad][0]!r} (expected one of {MODES})')
+    return i.ravel(), j.ravel(), radius.ravel(), concentration.ravel(), mode.ravel()
+
+
+# Flat indices of all in-bounds disk cells of a batch of events, and the index
+# of the event each cell belongs to
+def _cells(shape, i, j, radius, dx, dy):
+    nx, ny = shape
+    flat, owner = [], []
+    for r in np.unique(radius):
+        sel = np.nonzero(radius == r)[0]
+        di, dj = disk_offsets(float(r), dx, dy)
+        I = i[sel, None] + di
+        J = j[sel, None] + dj
+        inside = (I >= 0) & (I < nx) & (J >= 0) & (J < ny)
+        flat.append((I * ny + J)[inside])
+        owner.append(np.broadcast_to(sel[:, None], I.shape)[inside])
+    return np.concatenate(flat), np.concatenate(owner)
+
+
+# Stamp disk-shaped sources centred on cells (i, j) into field, clipped at the
+# grid edges. All arguments may be scalars or per-event arrays. mode 'set'
+# overwrites the concentration inside the disk, 'add' adds to it; events are
+# applied in order, so later events win where 'set' disks overlap. An
+# ensemble field (batch, nx, ny) gets the same sources in every member.
+def stamp(field, i, j, radius, concentration, mode='set', dx=1.0, dy=1.0):
+    if field.ndim > 2:
+        for member in field:
+            stamp(member, i, j, radius, concentration, mode, dx, dy)
+        return field
+    i, j, radius, concentration, mode = _as_events(i, j, radius, concentration, mode)
+    if not len(i):
+        return field
+    ny = field.shape[1]
+
+    # Process runs of consecutive events with the same mode in one go
+    starts = np.flatnonzero(np.r_[True, mode[1:] != mode[:-1]])
+    for a, b in zip(starts, np.r_[starts[1:], len(mode)]):
+        flat, owner = _cells(field.shape, i[a:b], j[a:b], radius[a:b], dx, dy)
+        if mode[a] == 'add':
+            np.add.at(field, (flat // ny, flat % ny), concentration[a:b][owner])
+        else:
+            # Keep only the last event that covers each cell
+            order = np.argsort(owner, kind='stable')[::-1]
+            flat, first = np.unique(flat[order], return_index=True)
+            field[flat // ny, flat % ny] = concentration[a:b][owner[order][first]]
+    return field
+
+
+# Convert source events from physical coordinates to grid cells
+def to_grid(events, dx, dy):
+    i = (events['y'] / dx).astype(int)
+    j = (events['x'] / dy).astype(int)
+    return i, j
+
+
+# Load source events from a CSV file with a header row (x, y, radius,
+# concentration and optional mode and t columns, default 'set' and 0), or from a .npy
+# file holding either an EVENT_DTYPE array or an (n, 4) float array
+def load_events(path):
+    if str(path).lower().endswith('.npy'):
+        data = np.load(path)
+        if data.dtype.names is None:
+            data = np.atleast_2d(np.asarray(data, float))
+            if data.shape[1] != 4:
+                raise ValueError(f'{path}: expected an (n, 4) array of x, y, radius, concentration')
+            names = ('x', 'y', 'radius', 'concentration')
+            columns = {name: data[:, k] for k, name in enumerate(names)}
+        else:
+            columns = {name: data[name] for name in data.dtype.names}
+    else:
+        data = np.genfromtxt(path, delimiter=',', names=True, dtype=None,
+                             encoding='utf-8', autostrip=True)
+        data = np.atleast_1d(data)
+        columns = {name.lower(): data[name] for name in data.dtype.names}
+
+    for name in ('x', 'y', 'radius', 'concentration'):
+        if name not in columns:
+            raise ValueError(f'{path}: missing column {name!r}')
+    events = np.zeros(len(columns['x']), EVENT_DTYPE)
+    for name in ('x', 'y', 'radius', 'concentration'):
+        events[name] = columns[name]
+    events['mode'] = columns.get('mode', 'set')
+    events['t'] = columns.get('t', 0.0)
+    bad = ~np.isin(events['mode'], MODES)
+    if bad.any():
+        raise ValueError(f'{path}: unknown source mode {events["mode"][bad][0]!r}')
+    return events
@@ -0,0 +1,220 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+import sources
+from solver import STEPPERS, default_stepper
+
+# Parameters a sweep can vary; None means the default scenario's value (or,
+# for the source, the scripts' initial radius 5 and concentration 10 at the
+# centre of the lake)
+PARAMETERS = ('D', 'dt', 'radius', 'concentration', 'x', 'y', 't_end')
+
+
+# All combinations of the given parameter values, as a list of points
+#   expand('fd', D=[1, 2, 5], radius=[2, 5, 10], t_end=[10])
+def expand(method, precision='float64', **ranges):
+    unknown = set(ranges) - set(PARAMETERS)
+    if unknown:
+        raise ValueError(f'unknown sweep parameters {sorted(unknown)} (expected some of {PARAMETERS})')
+    names = list(ranges)
+    return [{'method': method, 'precision': precision, **dict(zip(names, values))}
+            for values in itertools.product(*(np.ravel(ranges[name]).tolist() for name in names))]
+
+
+# Build the stepper of a sweep point: the method's default scenario with D
+# and dt replaced and one source stamped like a click in the scripts (radius
+# in cells, 'add' for the spectral method, 'set' otherwise). Returns the
+# stepper, the source events and the end time; deterministic, so the parent
+# process and the workers build the same scenario.
+def scenario(point):
+    stepper = default_stepper(point['method'], np.dtype(point.get('precision', 'float64')))
+    s = stepper.state
+    if point.get('D') is not None:
+        s.D = point['D']
+    if point.get('dt') is not None:
+        s.dt = point['dt']
+    nx, ny = s.field.shape
+    events = np.zeros(1, sources.EVENT_DTYPE)
+    events['x'] = _value(point, 'x', ny * s.dy / 2)
+    events['y'] = _value(point, 'y', nx * s.dx / 2)
+    events['radius'] = _value(point, 'radius', 5) * s.dx
+    events['concentration'] = _value(point, 'concentration', 10)
+    events['mode'] = 'add' if stepper.name == 'spectral' else 'set'
+    stepper.apply_events(events)
+    return stepper, events, _value(point, 't_end', 1.0)
+
+
+def _value(point, name, default):
+    value = point.get(name)
+    return default if value is None else value
+
+
+# Cache key of a scenario: a hash of everything that determines its result
+def scenario_key(stepper, events, t_end):
+    s = stepper.state
+    description = {
+        'method': stepper.name,
+        'grid': {'shape': list(s.field.shape), 'dx': float(s.dx), 'dy': float(s.dy),
+                 'dtype': s.field.dtype.name},
+        'D': float(s.D), 'dt': float(s.dt),
+        'sources': [[float(e[name]) for name in ('x', 'y', 'radius', 'concentration', 't')] + [str(e['mode'])]
+                    for e in events],
+        't_end': float(t_end),
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:32]
+
+
+# On-disk cache of final fields, one <key>.npy (read memory-mapped) and one
+# <key>.json with the run's metadata per scenario. Files are written next to
+# their final name and renamed, so an interrupted sweep leaves no partial
+# entries.
+class ResultCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key, '.npy')) and os.path.exists(self._path(key, '.json'))
+
+    def load(self, key):
+        with open(self._path(key, '.json')) as f:
+            meta = json.load(f)
+        return np.load(self._path(key, '.npy'), mmap_mode='r'), meta
+
+    def store(self, key, field, meta):
+        path = self._path(key, '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, field)
+        os.replace(path + '.tmp', path)
+        path = self._path(key, '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(path + '.tmp', path)
+
+
+# Worker process: run one point and write its final field into the shared
+# memory block the parent allocated, returning only the small metadata
+def _run_point(point, shm_name):
+    stepper, _, t_end = scenario(point)
+    start = time.perf_counter()
+    stepper.advance_to(t_end)
+    elapsed = time.perf_counter() - start
+    field = stepper.state.field
+    shm = SharedMemory(name=shm_name)
+    try:
+        np.ndarray(field.shape, field.dtype, buffer=shm.buf)[...] = field
+    finally:
+        shm.close()
+    return {'t': stepper.state.t, 'steps': stepper.state.step, 'elapsed': elapsed}
+
+
+# Run every point that is not in the cache yet on a pool of worker processes
+# (one per core by default) and return one result per point, in order:
+# {'point', 'key', 'field' (memory-mapped from the cache), 'meta', 'cached'}.
+# Final fields come back through shared memory rather than being pickled;
+# at most two blocks per worker exist at a time. Points with the same key
+# (also within one sweep) are run once.
+def run_sweep(points, cache_dir='sweep_cache', workers=None, progress=None):
+    cache = ResultCache(cache_dir)
+    keys, missing = [], {}
+    for point in points:
+        stepper, events, t_end = scenario(point)
+        key = scenario_key(stepper, events, t_end)
+        keys.append(key)
+        if key not in cache and key not in missing:
+            field = stepper.state.field
+            missing[key] = (point, field.shape, field.dtype)
+
+    if missing:
+        workers = workers or os.cpu_count()
+        todo = list(missing.items())
+        running = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            try:
+                while todo or running:
+                    while todo and len(running) < 2 * workers:
+                        key, (point, shape, dtype) = todo.pop(0)
+                        shm = SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+                        future = pool.submit(_run_point, point, shm.name)
+                        running[future] = (key, point, shape, dtype, shm)
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key, point, shape, dtype, shm = running.pop(future)
+                        try:
+                            meta = future.result()
+                            field = np.ndarray(shape, dtype, buffer=shm.buf)
+                            cache.store(key, field, {**meta, 'point': point})
+                            del field
+                        finally:
+                            shm.close()
+                            shm.unlink()
+                        if progress is not None:
+                            progress(point, meta)
+            finally:
+                for key, point, shape, dtype, shm in running.values():
+                    shm.close()
+                    shm.unlink()
+
+    results = []
+    for point, key in zip(points, keys):
+        field, meta = cache.load(key)
+        results.append({'point': point, 'key': key, 'field': field, 'meta': meta,
+                        'cached': key not in missing})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a parameter sweep of headless scenarios.')
+    parser.add_argument('method', choices=sorted(STEPPERS))
+    parser.add_argument('--D', type=float, nargs='+', help='diffusion coefficients (default: the scenario\'s)')
+    parser.add_argument('--dt', type=float, nargs='+')
+    parser.add_argument('--radius', type=float, nargs='+', default=[5], help='source radii in cells')
+    parser.add_argument('--concentration', type=float, nargs='+', default=[10])
+    parser.add_argument('--x', type=float, nargs='+', help='source positions (default: the centre)')
+    parser.add_argument('--y', type=float, nargs='+')
+    parser.add_argument('--t-end', type=float, nargs='+', default=[1.0])
+    parser.add_argument('--precision', choices=('float32', 'float64'), default='float64')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per core)')
+    parser.add_argument('--cache', default='sweep_cache', help='directory of cached results')
+    parser.add_argument('--output', help='save a summary table to this .csv file')
+    args = parser.parse_args(argv)
+
+    ranges = {name: getattr(args, name) for name in PARAMETERS if getattr(args, name) is not None}
+    points = expand(args.method, args.precision, **ranges)
+    start = time.perf_counter()
+    results = run_sweep(points, args.cache, args.workers)
+    elapsed = time.perf_counter() - start
+
+    rows = []
+    for result in results:
+        field, meta = result['field'], result['meta']
+        point = {name: result['point'].get(name) for name in ranges}
+        rows.append({**point, 'max': float(field.max()), 'mean': float(field.mean()),
+                     'run_s': meta['elapsed'], 'cached': result['cached']})
+        print(' '.join(f'{name}={value:g}' for name, value in point.items()),
+              f'max={rows[-1]["max"]:.4g} mean={rows[-1]["mean"]:.4g}',
+              '(cached)' if result['cached'] else f'({meta["elapsed"]:.2f} s)')
+    computed = sum(not result['cached'] for result in results)
+    print(f'{len(points)} points: {len(points) - computed} from the cache, {computed} computed '
+          f'in {elapsed:.2f} s')
+    if args.output:
+        names = list(rows[0])
+        with open(args.output, 'w') as f:
+            f.write(','.join(names) + '\n')
+            for row in rows:
+                f.write(','.join(str(row[name]) for name in names) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+import argparse
+import collections
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import sources
+from solver import State, Stepper, FiniteDifferenceStepper, ForwardEulerStepper
+
+# Rows of halo a strip needs above and below it, and whether the stencil
+# wraps around the first and last rows (the Euler fluxes are periodic)
+HALOS = {
+    'fd': (1, 1, False),
+    'euler': (2, 1, True),
+}
+_STEPPERS = {'fd': FiniteDifferenceStepper, 'euler': ForwardEulerStepper}
+
+
+# A 2-D grid stored in a memory-mapped file and accessed in tiles of
+# tile_rows full rows, so every tile is one contiguous, sequential range of
+# the file. At most cache_tiles tiles are held in memory; the least recently
+# used one is evicted (and written back if it was modified) when another is
+# needed. prefetch(k) starts reading tile k on a background thread so the
+# disk read overlaps the computation on the tiles before it.
+#   grid = TiledGrid('lake.dat', (20000, 20000), create=True)
+#   block = grid.read(a - 1, b + 1)   # rows a-1 .. b, wrapping around the edges
+#   grid.write(a, b, block[1:-1])
+class TiledGrid:
+    def __init__(self, path, shape, dtype=np.float64, tile_rows=256, cache_tiles=8, create=False):
+        if tile_rows < 2 or cache_tiles < 3:
+            raise ValueError(f'need tile_rows >= 2 and cache_tiles >= 3, got {tile_rows} and {cache_tiles}')
+        if len(shape) != 2:
+            raise ValueError(f'a tiled grid is 2-D, got shape {tuple(shape)}')
+        self.path = os.fspath(path)
+        self.array = np.memmap(self.path, dtype, 'w+' if create else 'r+', shape=tuple(shape))
+        self.shape, self.dtype = self.array.shape, self.array.dtype
+        self.tile_rows, self.cache_tiles = tile_rows, cache_tiles
+        self.tiles = -(-self.shape[0] // tile_rows)
+        self.hits = self.misses = 0
+        self._cache = collections.OrderedDict()  # tile index -> rows in memory
+        self._dirty = set()
+        self._loading = {}                       # tile index -> future of a prefetch
+        self._pool = None
+
+    # Rows [a, b) of tile k
+    def bounds(self, k):
+        return k * self.tile_rows, min((k + 1) * self.tile_rows, self.shape[0])
+
+    def _load(self, k):
+        a, b = self.bounds(k)
+        return np.array(self.array[a:b])
+
+    # Tile k in memory; a tile that will be fully overwritten is not read
+    def _tile(self, k, overwrite=False):
+        tile = self._cache.get(k)
+        if tile is not None:
+            self.hits += 1
+            self._cache.move_to_end(k)
+            return tile
+        future = self._loading.pop(k, None)
+        if future is not None:
+            self.hits += 1
+            tile = future.result()
+        elif overwrite:
+            a, b = self.bounds(k)
+            tile = np.empty((b - a,) + self.shape[1:], self.dtype)
+        else:
+            self.misses += 1
+            tile = self._load(k)
+        self._cache[k] = tile
+        while len(self._cache) > self.cache_tiles:
+            self._evict()
+        return tile
+
+    def _evict(self):
+        k, tile = self._cache.popitem(last=False)
+        if k in self._dirty:
+            a, b = self.bounds(k)
+            self.array[a:b] = tile
+            self._dirty.discard(k)
+
+    # Start reading tile k in the background (if it is not in memory yet)
+    def prefetch(self, k):
+        k %= self.tiles
+        if k in self._cache or k in self._loading:
+            return
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        self._loading[k] = self._pool.submit(self._load, k)
+
+    # Copy of rows [a, b); rows outside [0, nx) wrap around. Always a new
+    # array, so the caller may keep and modify it.
+    def read(self, a, b):
+        n = self.shape[0]
+        parts = []
+        row = a
+        while row < b:
+            k = (row % n) // self.tile_rows
+            tile = self._tile(k)
+            i = row % n - k * self.tile_rows
+            take = min(b - row, len(tile) - i)
+            parts.append(tile[i:i + take])
+            row += take
+        return np.concatenate(parts)
+
+    # Write values into rows [a, b) (within the grid)
+    def write(self, a, b, values):
+        row = a
+        while row < b:
+            k = row // self.tile_rows
+            start, stop = self.bounds(k)
+            end = min(b, stop)
+            tile = self._tile(k, overwrite=row == start and end == stop)
+            tile[row - start:end - start] = values[row - a:end - a]
+            self._dirty.add(k)
+            row = end
+
+    # Write all modified tiles back to the file
+    def flush(self):
+        for k in sorted(self._dirty):
+            a, b = self.bounds(k)
+            self.array[a:b] = self._cache[k]
+        self._dirty.clear()
+        self.array.flush()
+
+    # Forget the cached tiles after the file was modified through self.array
+    def invalidate(self):
+        for future in self._loading.values():
+            future.cancel()
+        self._loading.clear()
+        self._cache.clear()
+        self._dirty.clear()
+
+    # Bytes of the tiles held in memory
+    @property
+    def cached_bytes(self):
+        return sum(tile.nbytes for tile in self._cache.values())
+
+    def close(self):
+        self.flush()
+        self.invalidate()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+# Runs the FD or Euler stepper on a field that lives on disk and may be much
+# larger than memory. Each step streams through the grid one tile strip at a
+# time: the strip plus its halo rows is read from the current grid, advanced
+# by the unchanged in-memory stepper's _step() and its own rows are written
+# to a second (back) grid file, so results are identical to the in-memory
+# steppers; the grids are swapped after the step. Tiles of the next strip are
+# prefetched while the current one is computed, and each grid keeps at most
+# cache_tiles tiles in memory. state.field is the memory-mapped current grid
+# (flushed when it is read), so sources, probes and outputs work unchanged.
+# The field is read from path if state.field is a memory-mapped file already,
+# otherwise it is copied to path (a temporary file by default). close() moves
+# the final field to that file and removes the back grid.
+#   field = np.memmap('lake.dat', np.float64, 'w+', shape=(20000, 20000))
+#   stepper = TiledStepper(State(field, 1.0, 1.0, 2.0, 0.1), 'fd')
+class TiledStepper(Stepper):
+    name = 'tiled'
+
+    def __init__(self, state, method='fd', path=None, tile_rows=256, cache_tiles=8, workers=1):
+        super().__init__(state)
+        if method not in HALOS:
+            raise ValueError(f'unknown method {method!r} for the tiled backend (expected one of {tuple(HALOS)})')
+        field = state.field
+        if field.ndim != 2:
+            raise ValueError('the tiled backend holds a single 2-D field, not an ensemble')
+        if np.ndim(state.D):
+            raise ValueError('the tiled backend needs a scalar D')
+        self.method, self.tile_rows, self.cache_tiles = method, tile_rows, cache_tiles
+        if path is None and isinstance(field, np.memmap) and field.filename is not None:
+            path = field.filename
+        if path is None:
+            handle, path = tempfile.mkstemp(suffix='.dat')
+            os.close(handle)
+        self.path = os.path.abspath(path)
+        if not (isinstance(field, np.memmap) and field.filename == self.path):
+            front = TiledGrid(self.path, field.shape, field.dtype, tile_rows, cache_tiles, create=True)
+            front.array[:] = field
+        else:
+            front = TiledGrid(self.path, field.shape, field.dtype, tile_rows, cache_tiles)
+        handle, back_path = tempfile.mkstemp(suffix='.back', dir=os.path.dirname(self.path))
+        os.close(handle)
+        back = TiledGrid(back_path, field.shape, field.dtype, tile_rows, cache_tiles, create=True)
+        self._front, self._back = front, back
+        self._inner = _STEPPERS[method](State(None, state.dx, state.dy, state.D, state.dt), workers=workers)
+        state.field = front.array
+
+    def options(self):
+        return {'method': self.method, 'tile_rows': self.tile_rows, 'cache_tiles': self.cache_tiles}
+
+    # The memory-mapped field was modified in place
+    def refresh(self):
+        self._front.invalidate()
+
+    def _to_grid(self):
+        self._front.flush()
+        return self._front.array
+
+    def _step(self):
+        s = self.state
+        front, back = self._front, self._back
+        inner = self._inner
+        inner.state.dx, inner.state.dy, inner.state.D, inner.state.dt = s.dx, s.dy, s.D, s.dt
+        above, below, wrap = HALOS[self.method]
+        nx = front.shape[0]
+        for k in range(front.tiles):
+            a, b = front.bounds(k)
+            front.prefetch(k + 2)  # the next strip's halo below
+            lo, hi = (a - above, b + below) if wrap else (max(a - above, 0), min(b + below, nx))
+            inner.state.field = front.read(lo, hi)
+            inner._step()
+            out = inner.state.field
+            if wrap and a == 0:
+                # The no-flux copy of the first row, which the strip's own
+                # step applied to its halo row instead
+                out[a - lo] = out[a - lo + 1]
+            back.write(a, b, out[a - lo:b - lo])
+            if wrap and b == nx:
+                # The last strip may be a single row, so copy from the grid
+                back.write(nx - 1, nx, back.read(nx - 2, nx - 1))
+        self._front, self._back = back, front
+        s.defer_field(self._to_grid)
+
+    # Tile caches of both grids and the strip the in-memory stepper works on
+    def projected_bytes(self):
+        front = self._front
+        row = front.array[0].nbytes
+        strip = (self.tile_rows + 3) * row * (1 + self._inner.work_arrays)
+        return 2 * self.cache_tiles * self.tile_rows * row + strip
+
+    def allocated_bytes(self):
+        return self._front.cached_bytes + self._back.cached_bytes
+
+    # Flush, keep the final field in path and remove the back grid file
+    def close(self):
+        s = self.state
+        front, back = self._front, self._back
+        front.close()
+        back.close()
+        self._inner.close()
+        shape, dtype = front.shape, front.dtype
+        s.field = front.array = back.array = None
+        if front.path != self.path:
+            os.replace(front.path, self.path)
+        else:
+            os.remove(back.path)
+        s.field = np.memmap(self.path, dtype, 'r+', shape=shape)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a diffusion scenario on a grid stored on disk.')
+    parser.add_argument('--method', choices=sorted(HALOS), default='fd')
+    parser.add_argument('--shape', nargs=2, type=int, default=(4000, 4000), metavar=('NX', 'NY'))
+    parser.add_argument('--path', help='grid file (read if it exists, else created; default: temporary)')
+    parser.add_argument('--dx', type=float, default=1.0)
+    parser.add_argument('--D', type=float, default=2.0)
+    parser.add_argument('--dt', type=float, default=0.1)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--tile-rows', type=int, default=256)
+    parser.add_argument('--cache-tiles', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=1, help='threads for the strip kernels')
+    parser.add_argument('--source', nargs=4, type=float, metavar=('X', 'Y', 'RADIUS', 'CONC'),
+                        help='initial source in physical units')
+    parser.add_argument('--precision', choices=('float32', 'float64'), default='float64')
+    args = parser.parse_args(argv)
+
+    shape = tuple(args.shape)
+    if args.path and os.path.exists(args.path):
+        field = np.memmap(args.path, args.precision, 'r+', shape=shape)
+    else:
+        path = args.path
+        if path is None:
+            handle, path = tempfile.mkstemp(suffix='.dat')
+            os.close(handle)
+        field = np.memmap(path, args.precision, 'w+', shape=shape)
+    state = State(field, args.dx, args.dx, args.D, args.dt)
+    stepper = TiledStepper(state, args.method, tile_rows=args.tile_rows,
+                           cache_tiles=args.cache_tiles, workers=args.workers)
+    if args.source:
+        events = np.zeros(1, sources.EVENT_DTYPE)
+        for name, value in zip(('x', 'y', 'radius', 'concentration'), args.source):
+            events[name] = value
+        events['mode'] = 'set'
+        stepper.apply_events(events)
+    print(stepper.memory_report())
+    start = time.perf_counter()
+    stepper.advance(args.steps)
+    elapsed = time.perf_counter() - start
+    front = stepper._front
+    cells = args.steps * shape[0] * shape[1]
+    print(f'tiled {args.method}: {args.steps} steps to t={state.t:.4g} in {elapsed:.3f} s '
+          f'({cells / max(elapsed, 1e-12) / 1e6:.1f} Mcells/s), tile cache {front.hits} hits, '
+          f'{front.misses} misses')
+    stepper.close()
+    print(f'field saved to {stepper.path}')
+
+
+if __name__ == '__main__':
+    main()